@@ -0,0 +1,232 @@
+#!/bin/env python3
+
+'''
+    raspi-img2headless-benchmark.py | Measure raspi-img2headless.py on synthetic images and loop-backed targets.
+    Copyright (C) 2021  https://github.com/TheH-2090
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, visit www.gnu.org/licenses/
+'''
+
+import subprocess
+import json
+import random
+import platform
+from sys import argv, executable
+from os import getuid, path, makedirs, remove, wait4, waitstatus_to_exitcode
+from time import time, strftime
+from statistics import median
+
+MiB = 1024 * 1024
+RESULTS_VERSION = 1
+TOOL = path.join(path.dirname(path.abspath(__file__)), 'raspi-img2headless.py')
+USAGE = 'Usage: raspi-img2headless-benchmark.py [--image-size=<MiB>] [--files=<number>] [--targets=<number>] [--modes=file,block,stream] [--runs=<number>] [--compress=gz|xz] [--verify] [--work=<directory>] [--output=<file>] [--compare=<file>] [--threshold=<percent>]'
+
+def get_option(name, default=None):
+    for argument in argv[1:]:
+        if argument == f'--{name}':
+            return True
+        if argument.startswith(f'--{name}='):
+            return argument.split('=', 1)[1]
+    return default
+
+def execute(command):
+    task = subprocess.run(command, shell=True, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    if task.returncode != 0:
+        raise Exception(f'{command} failed:', *task.stdout.decode().strip('\n').split('\n'))
+    return task.stdout.decode().strip('\n')
+
+def build_image(image, size, files, seed=2021):
+    mount_point = f'{image}.mnt'
+    generator = random.Random(seed)
+    execute(f'truncate -s {size * MiB} {image}')
+    execute(f'parted -s {image} mktable msdos mkpart primary fat32 4MiB 260MiB mkpart primary ext4 260MiB 100%')
+    loop = execute(f'losetup -f --show -P {image}')
+    try:
+        execute(f'mkfs.vfat -F 32 -n boot {loop}p1')
+        execute(f'mkfs.ext4 -q -L rootfs {loop}p2')
+        partuuid = execute(f'blkid -s PTUUID -o value {loop}')
+        execute(f'mkdir -p {mount_point} && mount {loop}p2 {mount_point} && mkdir -p {mount_point}/boot && mount {loop}p1 {mount_point}/boot')
+        try:
+            boot_files = {
+                'cmdline.txt': f'console=serial0,115200 console=tty1 root=PARTUUID={partuuid}-02 rootfstype=ext4 fsck.repair=yes rootwait init=/usr/lib/raspi-config/init_resize.sh\n',
+                'config.txt': 'dtparam=audio=on\ncamera_auto_detect=1\ndisplay_auto_detect=1\n',
+            }
+            root_files = {
+                'etc/hostname': 'raspberrypi\n',
+                'etc/hosts': '127.0.0.1\tlocalhost\n127.0.1.1\traspberrypi\n',
+                'etc/fstab': f'proc /proc proc defaults 0 0\nPARTUUID={partuuid}-01 /boot vfat defaults 0 2\nPARTUUID={partuuid}-02 / ext4 defaults,noatime 0 1\n',
+            }
+            for directory, contents in [('boot', boot_files), ('', root_files)]:
+                for name, content in contents.items():
+                    makedirs(path.dirname(path.join(mount_point, directory, name)), exist_ok=True)
+                    with open(path.join(mount_point, directory, name), 'w') as file:
+                        file.write(content)
+            with open(f'{mount_point}/boot/kernel8.img', 'wb') as file:
+                file.write(generator.randbytes(8 * MiB))
+            budget = (size - 260) * MiB // 2
+            for number in range(files):
+                length = min(int(generator.paretovariate(1.2) * 4096), 16 * MiB, max(budget // max(files - number, 1), 0))
+                name = f'{mount_point}/usr/share/bench/{number // 256:03d}/{number % 256:03d}.bin'
+                makedirs(path.dirname(name), exist_ok=True)
+                with open(name, 'wb') as file:
+                    file.write(generator.randbytes(length // 2) + bytes(length - length // 2))
+                budget -= length
+        finally:
+            execute(f'umount {mount_point}/boot; umount {mount_point}; rmdir {mount_point}')
+    finally:
+        execute(f'losetup -d {loop}')
+
+def compress_image(image, method):
+    execute(f"{ {'gz': 'gzip', 'xz': 'xz'}[method]} -k -f -1 {image}")
+    return f'{image}.{method}'
+
+def attach_targets(work, count, size):
+    loops = []
+    for number in range(1, count + 1):
+        target = f'{work}/target-{number}.img'
+        execute(f'truncate -s 0 {target} && truncate -s {size * MiB} {target}')
+        loops.append(execute(f'losetup -f --show -P {target}').split('/')[-1])
+    return loops
+
+def detach_targets(loops):
+    for loop in loops:
+        subprocess.run(f'losetup -d /dev/{loop}', shell=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+
+def run_scenario(work, image, mode, loops, verify):
+    settings_file = f'{work}/settings.json'
+    events_file = f'{work}/events-{mode}.jsonl'
+    with open(settings_file, 'w') as file:
+        json.dump({'Target': loops, 'Activate SSH': True, 'Modify hostname': True, 'Hostname entered': 'bench-{n}'}, file)
+    if path.exists(events_file):
+        remove(events_file)
+    command = [executable, TOOL, image, f'--copy={mode}', f'--settings={settings_file}', f'--events={events_file}', f'--journal={work}/journal', '--restart', '--no-progress']
+    if verify:
+        command.append('--verify')
+    started = time()
+    with open(f'{work}/output-{mode}.log', 'w') as log:
+        task = subprocess.Popen(command, stdin=subprocess.DEVNULL, stdout=log, stderr=subprocess.STDOUT)
+        pid, status, usage = wait4(task.pid, 0)
+    run = {
+        'success': waitstatus_to_exitcode(status) == 0,
+        'seconds': round(time() - started, 3),
+        'peak rss bytes': usage.ru_maxrss * 1024,
+        'stages': {},
+        'commands': {},
+    }
+    names = {loop: f'target {number}' for number, loop in enumerate(loops, start=1)}
+    with open(events_file, 'r') as file:
+        for line in file:
+            event = json.loads(line)
+            target = names.get(event.get('target'), event.get('target'))
+            if event['event'] == 'step':
+                stage = f"{target}: {event['step']}"
+                run['stages'][stage] = round(run['stages'].get(stage, 0) + event['seconds'], 3)
+            elif event['event'] == 'command':
+                command_name = event['command'].split(' ')[0]
+                run['commands'][command_name] = round(run['commands'].get(command_name, 0) + event['seconds'], 3)
+    return run
+
+def summarize(runs):
+    stages = {}
+    for run in runs:
+        for stage, seconds in run['stages'].items():
+            stages.setdefault(stage, []).append(seconds)
+    return {
+        'success': all(run['success'] for run in runs),
+        'seconds': median(run['seconds'] for run in runs),
+        'peak rss bytes': max(run['peak rss bytes'] for run in runs),
+        'stages': {stage: median(values) for stage, values in stages.items()},
+    }
+
+def compare_results(old, new, threshold):
+    regressions = []
+    print(f"{'scenario / stage':<60} {'old':>10} {'new':>10} {'change':>8}")
+    for scenario, summary in new['scenarios'].items():
+        previous = old['scenarios'].get(scenario)
+        if previous is None:
+            continue
+        rows = [('total seconds', previous['summary']['seconds'], summary['summary']['seconds'])]
+        rows.append(('peak rss MiB', previous['summary']['peak rss bytes'] / MiB, summary['summary']['peak rss bytes'] / MiB))
+        for stage, seconds in summary['summary']['stages'].items():
+            if stage in previous['summary']['stages']:
+                rows.append((stage, previous['summary']['stages'][stage], seconds))
+        for name, before, after in rows:
+            change = (after - before) / before * 100 if before else 0
+            marker = ' !' if change > threshold and after - before > 0.1 else ''
+            if marker:
+                regressions.append(f'{scenario} / {name}')
+            print(f"{(scenario + ' / ' + name)[:60]:<60} {before:>10.2f} {after:>10.2f} {change:>7.1f}%{marker}")
+    return regressions
+
+def main():
+    if getuid() != 0:
+        quit('Error: The benchmark needs root privileges for loop devices and mounts.')
+    try:
+        image_size = int(get_option('image-size', 1024))
+        files = int(get_option('files', 2000))
+        targets = int(get_option('targets', 2))
+        runs = int(get_option('runs', 1))
+        threshold = float(get_option('threshold', 10))
+    except ValueError:
+        quit(USAGE)
+    modes = get_option('modes', 'file,block,stream').split(',')
+    compress = get_option('compress')
+    if any(mode not in ['file', 'block', 'stream'] for mode in modes) or compress not in [None, 'gz', 'xz']:
+        quit(USAGE)
+    if compress is not None:
+        modes = ['stream']
+    work = get_option('work', '/var/tmp/raspi-img2headless-benchmark')
+    output = get_option('output', f"{work}/results-{strftime('%Y%m%d-%H%M%S')}.json")
+    makedirs(work, exist_ok=True)
+    image = f'{work}/synthetic-{image_size}M-{files}.img'
+    if not(path.exists(image)):
+        print(f'Building synthetic image {image}.')
+        build_image(image, image_size, files)
+    if compress is not None:
+        image = compress_image(image, compress)
+    results = {
+        'version': RESULTS_VERSION,
+        'created': time(),
+        'host': platform.node(),
+        'kernel': platform.release(),
+        'config': {'image size MiB': image_size, 'files': files, 'targets': targets, 'runs': runs, 'compress': compress, 'verify': bool(get_option('verify'))},
+        'scenarios': {},
+    }
+    for mode in modes:
+        scenario = mode if compress is None else f'{mode}-{compress}'
+        scenario_runs = []
+        for run in range(runs):
+            loops = attach_targets(work, targets, image_size + image_size // 4)
+            try:
+                print(f'Running {scenario} ({run + 1}/{runs}) on {", ".join(loops)}.')
+                scenario_runs.append(run_scenario(work, image, mode, loops, bool(get_option('verify'))))
+            finally:
+                detach_targets(loops)
+            print(f"{scenario}: {scenario_runs[-1]['seconds']} s, peak RSS {scenario_runs[-1]['peak rss bytes'] // MiB} MiB, {'successful' if scenario_runs[-1]['success'] else 'failed'}.")
+        results['scenarios'][scenario] = {'runs': scenario_runs, 'summary': summarize(scenario_runs)}
+    with open(output, 'w') as file:
+        json.dump(results, file, indent=2)
+    print(f'Results written to {output}.')
+    failed = [scenario for scenario, result in results['scenarios'].items() if not(result['summary']['success'])]
+    regressions = []
+    if get_option('compare') is not None:
+        with open(get_option('compare'), 'r') as file:
+            regressions = compare_results(json.load(file), results, threshold)
+    if failed:
+        quit(f"Error: Failed scenarios: {', '.join(failed)}")
+    if regressions:
+        quit(f"Error: Regressions above {threshold}%: {', '.join(regressions)}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,217 @@
+#!/bin/env python3
+
+'''
+    raspi-img2headless-formatcheck.py | Check the GPT, FAT and ext4 writers of raspi-img2headless.py on plain image files.
+    Copyright (C) 2021  https://github.com/TheH-2090
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, visit www.gnu.org/licenses/
+'''
+
+import subprocess
+import struct
+import zlib
+import random
+import tempfile
+import importlib.util
+from sys import argv
+from os import path, makedirs
+from shutil import which
+
+MiB = 1024 * 1024
+TOOL = path.join(path.dirname(path.abspath(__file__)), 'raspi-img2headless.py')
+USAGE = 'Usage: raspi-img2headless-formatcheck.py [--checks=gpt,fat,ext4] [--work=<directory>]'
+
+def get_option(name, default=None):
+    for argument in argv[1:]:
+        if argument == f'--{name}':
+            return True
+        if argument.startswith(f'--{name}='):
+            return argument.split('=', 1)[1]
+    return default
+
+def load_tool():
+    spec = importlib.util.spec_from_file_location('raspi_img2headless', TOOL)
+    tool = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(tool)
+    return tool
+
+def execute(command):
+    task = subprocess.run(command, shell=True, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    if task.returncode != 0:
+        raise Exception(f'{command} failed:', *task.stdout.decode().strip('\n').split('\n'))
+    return task.stdout.decode().strip('\n')
+
+def read_at(image, length, offset):
+    with open(image, 'rb') as file:
+        file.seek(offset)
+        return file.read(length)
+
+def check_gpt_header(image, lba, sector_size, other_lba):
+    header = read_at(image, 92, lba * sector_size)
+    if header[:8] != b'EFI PART':
+        raise Exception(f'No GPT header at LBA {lba}.')
+    crc, = struct.unpack_from('<I', header, 16)
+    if zlib.crc32(header[:16] + bytes(4) + header[20:]) != crc:
+        raise Exception(f'The header CRC at LBA {lba} is wrong.')
+    current, backup, first_usable, last_usable = struct.unpack_from('<QQQQ', header, 24)
+    entries_lba, count, entry_size, entries_crc = struct.unpack_from('<QIII', header, 72)
+    if current != lba or backup != other_lba:
+        raise Exception(f'The header at LBA {lba} points to LBA {current} and {backup}.')
+    entries = read_at(image, count * entry_size, entries_lba * sector_size)
+    if zlib.crc32(entries) != entries_crc:
+        raise Exception(f'The partition entry CRC of the header at LBA {lba} is wrong.')
+    return header[56:72], entries, first_usable, last_usable
+
+def check_gpt(tool, work, sector_size):
+    image = f'{work}/gpt-{sector_size}.img'
+    size = 300 * MiB
+    execute(f'truncate -s 0 {image} && truncate -s {size} {image}')
+    layout = [(tool.PARTITION_ALIGNMENT, 256000000, 'fat32', 'sdaboot'), (256000000, None, 'ext4', 'sdaroot')]
+    written = tool.write_gpt(image, size, layout, sector_size)
+    sectors = size // sector_size
+    mbr = read_at(image, 512, 0)
+    protective_type, protective_start = struct.unpack_from('<4xB3xI', mbr, 446)
+    if mbr[510:512] != b'\x55\xaa' or protective_type != 0xEE or protective_start != 1:
+        raise Exception('The protective MBR is missing.')
+    primary = check_gpt_header(image, 1, sector_size, sectors - 1)
+    backup = check_gpt_header(image, sectors - 1, sector_size, 1)
+    if primary != backup:
+        raise Exception('The backup header and entries differ from the primary ones.')
+    partitions = tool.read_partition_table(lambda length, offset: read_at(image, length, offset), sector_size)
+    if [(partition['start'], partition['size']) for partition in partitions] != [(first * sector_size, length * sector_size) for first, length, name in written]:
+        raise Exception('The partitions read back differ from the written layout.')
+    for partition, (start, end, kind, name) in zip(partitions, layout):
+        if partition['start'] % tool.PARTITION_ALIGNMENT or partition['type'] != tool.GPT_TYPES[kind]:
+            raise Exception(f'Partition {name} is not aligned or has the wrong type.')
+    if which('sfdisk'):
+        execute(f'sfdisk --sector-size {sector_size} --verify {image}')
+
+def fat_files(generator, cluster_size):
+    return [
+        ('config.txt', b'dtparam=audio=on\n'),
+        ('ssh', b''),
+        ('wpa_supplicant.conf', generator.randbytes(300)),
+        ('A long file name with spaces.txt', generator.randbytes(3 * cluster_size + 17)),
+        ('cmdline.txt', b'console=tty1 root=PARTUUID=00000000-02 rootwait\n'),
+    ]
+
+def check_fat(tool, work, fat_type):
+    if not(which('mkfs.vfat')):
+        return 'mkfs.vfat not found'
+    image = f'{work}/fat{fat_type}.img'
+    execute(f'truncate -s 0 {image} && truncate -s {64 * MiB if fat_type == 16 else 300 * MiB} {image}')
+    execute(f'mkfs.vfat -F {fat_type} -n boot {image}')
+    generator = random.Random(fat_type)
+    volume = tool.FatVolume(image)
+    files = fat_files(generator, volume.cluster_size)
+    for name, content in files:
+        volume.write(name, content)
+    files[3] = (files[3][0], generator.randbytes(volume.cluster_size // 2))
+    files[4] = (files[4][0], files[4][1] * 200)
+    for name, content in files[3:]:
+        volume.write(name, content)
+    volume.close()
+    volume = tool.FatVolume(image)
+    try:
+        for name, content in files:
+            if volume.read(name) != content:
+                raise Exception(f'{name} reads back differently.')
+        copies = {bytes(tool.pread(volume.fd, len(volume.fat), offset)) for offset in volume.fat_offsets}
+        if len(copies) != 1:
+            raise Exception('The FAT copies differ.')
+        for name, content in files:
+            clusters = volume.chain(tool.fat_first_cluster(volume.lookup(name)[1]))
+            if len(clusters) != -(-len(content) // volume.cluster_size):
+                raise Exception(f'The cluster chain of {name} does not match its size.')
+    finally:
+        volume.close()
+    if which('fsck.vfat'):
+        execute(f'fsck.vfat -n {image}')
+
+def check_ext4(tool, work, features):
+    if not(which('mkfs.ext4') and which('e2fsck') and which('debugfs')):
+        return 'mkfs.ext4, e2fsck or debugfs not found'
+    image = f"{work}/ext4-{features.replace('^', 'no-').replace(',', '-') or 'default'}.img"
+    root = f'{image}.root'
+    files = {
+        'etc/hostname': b'raspberrypi\n',
+        'etc/hosts': b'127.0.0.1\tlocalhost\n127.0.1.1\traspberrypi\n',
+        'etc/fstab': b'proc /proc proc defaults 0 0\nPARTUUID=00000000-01 /boot vfat defaults 0 2\n',
+    }
+    for name, content in files.items():
+        makedirs(path.dirname(f'{root}/{name}'), exist_ok=True)
+        with open(f'{root}/{name}', 'wb') as file:
+            file.write(content)
+    execute(f'truncate -s 0 {image} && truncate -s {64 * MiB} {image}')
+    execute(f"mkfs.ext4 -q -F {'-O ' + features if features else ''} -d {root} {image}")
+    files['etc/hostname'] = b'provisioned\n'
+    files['etc/hosts'] = b'127.0.0.1\tlocalhost\n127.0.1.1\tprovisioned\n' * 200
+    files['etc/wpa_supplicant/wpa_supplicant.conf'] = b'country=DE\nnetwork={\n\tssid="test"\n}\n'
+    execute(f'debugfs -w -R "mkdir /etc/wpa_supplicant" {image}')
+    volume = tool.Ext4Volume(image)
+    try:
+        for name, content in files.items():
+            volume.write(name, content)
+    finally:
+        volume.close()
+    execute(f'e2fsck -fn {image}')
+    volume = tool.Ext4Volume(image, flags=tool.O_RDONLY)
+    try:
+        for name, content in files.items():
+            if volume.read(name) != content:
+                raise Exception(f'{name} reads back differently.')
+    finally:
+        volume.close()
+    for name, content in files.items():
+        task = subprocess.run(['debugfs', '-R', f'cat /{name}', image], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        if task.stdout != content:
+            raise Exception(f'debugfs reads {name} differently.')
+
+def run_checks(tool, work, checks):
+    scenarios = []
+    if 'gpt' in checks:
+        scenarios += [(f'GPT, {sector_size} byte sectors', check_gpt, sector_size) for sector_size in [512, 4096]]
+    if 'fat' in checks:
+        scenarios += [(f'FAT{fat_type} write', check_fat, fat_type) for fat_type in [16, 32]]
+    if 'ext4' in checks:
+        scenarios += [(f"ext4 write ({features or 'default features'})", check_ext4, features) for features in ['metadata_csum,64bit', '^metadata_csum', '^extent,^flex_bg,^64bit,^metadata_csum']]
+    failed = []
+    for name, check, argument in scenarios:
+        try:
+            skipped = check(tool, work, argument)
+        except Exception as e:
+            failed.append(name)
+            print(f'{name}: failed')
+            print('\n'.join(f'\t{arg}' for arg in e.args))
+            continue
+        print(f'{name}: skipped, {skipped}' if skipped else f'{name}: ok')
+    return failed
+
+def main():
+    checks = get_option('checks', 'gpt,fat,ext4').split(',')
+    if any(check not in ['gpt', 'fat', 'ext4'] for check in checks):
+        quit(USAGE)
+    tool = load_tool()
+    work = get_option('work')
+    if work is None:
+        with tempfile.TemporaryDirectory(prefix='raspi-img2headless-formatcheck-') as work:
+            failed = run_checks(tool, work, checks)
+    else:
+        makedirs(work, exist_ok=True)
+        failed = run_checks(tool, work, checks)
+    if failed:
+        quit(f"Error: Failed checks: {', '.join(failed)}")
+
+if __name__ == '__main__':
+    main()
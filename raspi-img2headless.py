@@ -19,41 +19,1021 @@
 '''
 
 import subprocess
-from sys import argv
-from os import getcwd, getuid, path
+import struct
+import json
+import hashlib
+import gzip
+import lzma
+import zipfile
+import mmap
+import uuid
+import zlib
+import ctypes
+import tempfile
+import shlex
+import socket
+from sys import argv, stdout, executable
+from os import getcwd, getuid, path, pread, pwrite, preadv, fsync, write, statvfs, walk, lstat, sync, urandom
+from os import posix_fadvise, POSIX_FADV_DONTNEED, O_WRONLY, O_RDONLY, O_RDWR, O_DIRECT
+from os import wait4, waitstatus_to_exitcode
+from os import scandir, mkdir, symlink, readlink, mknod, link, unlink, lchown, chmod, copy_file_range, sendfile
+from os import listxattr, getxattr, setxattr, fdatasync, strerror, O_CREAT, O_TRUNC, O_DIRECTORY
+from os import open as os_open, close as os_close, makedirs, listdir, remove, rename, rmdir, stat, utime
+from time import time, sleep, localtime
+from stat import S_ISREG, S_ISDIR, S_ISBLK, S_ISLNK, S_IMODE
+from shutil import which
+from fnmatch import fnmatch
+from queue import Queue, Full
+from fcntl import ioctl, flock, LOCK_EX
+from errno import EBUSY, EXDEV, ENOSYS, EINVAL, EOPNOTSUPP
+from threading import Thread, Event, Lock, local
 from getpass import getpass
+from functools import partial, lru_cache
+from itertools import accumulate
+from bisect import bisect_right
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait, FIRST_COMPLETED
+
+MiB = 1024 * 1024
+CHUNK_SIZE = 4 * MiB
+BLKZEROOUT = 0x127F
+BLKRRPART = 0x125F
+BLKDISCARD = 0x1277
+GPT_TYPES = {'fat32': 'EBD0A0A2-B9E5-4433-87C0-68B6B72699C7', 'ext4': '0FC63DAF-8483-4772-8E79-3D69D8477DE4'}
+GPT_ENTRIES = 128
+PARTITION_ALIGNMENT = 4 * MiB
+PARTITION_TIMEOUT = 30
+COMPRESSED_TYPES = ['.xz', '.gz', '.zip', '.zst']
+CACHE_VERSION = 1
+SIZE_UNITS = {'K': 1024, 'M': MiB, 'G': 1024 * MiB, 'T': 1024 * 1024 * MiB}
+CHECKPOINT_SIZE = 256 * MiB
+RESUMABLE_STEPS = ['probe', 'discard', 'partition', 'format boot', 'format root', 'copy boot', 'copy root', 'verify boot', 'verify root', 'grow root', 'ssh', 'wifi', 'cmdline', 'fstab', 'hostname']
+DIRECT_ALIGNMENT = 4096
+DELTA_BLOCK = MiB
+COPY_THREADS = 16
+MAX_INFLIGHT = 64 * MiB
+SYNC_FILE_RANGE_WAIT_BEFORE = 1
+SYNC_FILE_RANGE_WRITE = 2
+SYNC_FILE_RANGE_WAIT_AFTER = 4
+LIBC = ctypes.CDLL(None, use_errno=True)
+INDEX_VERSION = 3
+EXTENDED_PARTITIONS = [0x05, 0x0F, 0x85]
+NETLINK_KOBJECT_UEVENT = 15
+HOTPLUG_SETTLE = 2
+HOTPLUG_POLL = 1
+RULE_KEYS = ['Minimum size', 'Maximum size', 'Vendor', 'Model', 'Serial', 'Removable']
+STORE_PREFIX = 'store:'
+STORE_VERSION = 1
+STORE_BLOCK = 4096
+STORE_MIN_CHUNK = 256 * 1024
+STORE_MAX_CHUNK = 4 * MiB
+STORE_MASK = 0xFF
+GAUGE_METRICS = ['run_duration_seconds', 'run_failed_targets']
+PARTITION_FILESYSTEMS = {'0x0b': 'vfat', '0x0c': 'vfat', '0x0e': 'vfat', '0x83': 'ext4', GPT_TYPES['fat32']: 'vfat', GPT_TYPES['ext4']: 'ext4'}
+
+class TargetError(Exception):
+    pass
+
+class Instrumentation(object):
+    def __init__(self, print_lock, events=None, prometheus=None, progress=False):
+        self.print_lock = print_lock
+        self.events = open(events, 'a') if events else None
+        self.prometheus = prometheus
+        self.show_progress = progress
+        self.lock = Lock()
+        self.started = time()
+        self.samples = {}
+        self.counters = local()
+        self.progress = {}
+        self.progress_shown = False
+        self.progress_stop = Event()
+        self.progress_thread = None
+
+    def emit(self, kind, **fields):
+        event = {'time': round(time(), 3), 'event': kind}
+        event.update(fields)
+        with self.lock:
+            if self.events is not None:
+                self.events.write(json.dumps(event) + '\n')
+                self.events.flush()
+
+    def add_sample(self, metric, labels, value):
+        key = (metric, tuple(sorted(labels.items())))
+        with self.lock:
+            self.samples[key] = self.samples.get(key, 0) + value
+
+    def thread_io(self):
+        counters = {}
+        try:
+            with open('/proc/thread-self/io', 'r') as file:
+                for line in file:
+                    name, value = line.split(':')
+                    counters[name] = int(value)
+        except OSError:
+            pass
+        return counters.get('rchar', 0), counters.get('wchar', 0)
+
+    def device_io(self, drive):
+        try:
+            with open(f'/sys/block/{drive}/stat', 'r') as file:
+                fields = file.read().split()
+            return int(fields[2]) * 512, int(fields[6]) * 512
+        except (OSError, IndexError):
+            return None
+
+    def measure(self, target, step, drives, total, function):
+        started = time()
+        read, written = self.thread_io()
+        self.counters.children = [0, 0]
+        devices = {drive: self.device_io(drive) for drive in drives}
+        devices = {drive: counters for drive, counters in devices.items() if counters is not None}
+        if total is not None:
+            for drive in devices:
+                self.start_progress(drive, devices[drive][1], total / len(devices))
+        success = False
+        try:
+            function()
+            success = True
+        finally:
+            if total is not None:
+                for drive in devices:
+                    self.stop_progress(drive)
+            seconds = time() - started
+            read_now, written_now = self.thread_io()
+            fields = {
+                'target': target,
+                'step': step,
+                'success': success,
+                'seconds': round(seconds, 3),
+                'read bytes': read_now - read + self.counters.children[0],
+                'written bytes': written_now - written + self.counters.children[1],
+            }
+            device_read = device_written = 0
+            for drive, (start_read, start_written) in devices.items():
+                now = self.device_io(drive) or (start_read, start_written)
+                device_read += now[0] - start_read
+                device_written += now[1] - start_written
+            if devices:
+                fields['device read bytes'] = device_read
+                fields['device written bytes'] = device_written
+            fields['MB/s'] = round(max(fields['written bytes'], device_written) / seconds / 1e6, 2) if seconds else 0
+            self.emit('step', **fields)
+            labels = {'target': target, 'step': step.rstrip('.')}
+            self.add_sample('step_duration_seconds', labels, seconds)
+            self.add_sample('step_read_bytes', labels, fields['read bytes'])
+            self.add_sample('step_written_bytes', labels, fields['written bytes'])
+            if devices:
+                self.add_sample('step_device_read_bytes', labels, device_read)
+                self.add_sample('step_device_written_bytes', labels, device_written)
+            self.add_sample('step_failures', labels, 0 if success else 1)
+
+    def run_command(self, target, command, task):
+        started = time()
+        pid, status, usage = wait4(task.pid, 0)
+        task.returncode = waitstatus_to_exitcode(status)
+        seconds = time() - started
+        read, written = usage.ru_inblock * 512, usage.ru_oublock * 512
+        if hasattr(self.counters, 'children'):
+            self.counters.children[0] += read
+            self.counters.children[1] += written
+        rate = round(written / seconds / 1e6, 2) if seconds else 0
+        self.emit('command', target=target, command=command, returncode=task.returncode, seconds=round(seconds, 3), **{'read bytes': read, 'written bytes': written, 'MB/s': rate, 'max rss bytes': usage.ru_maxrss * 1024})
+        labels = {'target': target, 'command': command.split(' ')[0]}
+        self.add_sample('command_duration_seconds', labels, seconds)
+        self.add_sample('command_read_bytes', labels, read)
+        self.add_sample('command_written_bytes', labels, written)
+        self.add_sample('command_runs', labels, 1)
+
+    def start_progress(self, drive, written, total):
+        with self.lock:
+            if drive in self.progress:
+                self.progress[drive][2] += total
+                self.progress[drive][3] += 1
+            else:
+                self.progress[drive] = [written, time(), total, 1]
+            if self.show_progress and self.progress_thread is None:
+                self.progress_stop.clear()
+                self.progress_thread = Thread(target=self.render_progress, daemon=True)
+                self.progress_thread.start()
+
+    def stop_progress(self, drive):
+        with self.lock:
+            self.progress[drive][3] -= 1
+            if not(self.progress[drive][3]):
+                del self.progress[drive]
+            thread = self.progress_thread if not(self.progress) else None
+            if thread is not None:
+                self.progress_thread = None
+                self.progress_stop.set()
+        if thread is not None:
+            thread.join()
+
+    def render_progress(self):
+        while not(self.progress_stop.wait(0.5)):
+            parts = []
+            with self.lock:
+                progress = dict(self.progress)
+            for drive, (start_written, started, total, users) in sorted(progress.items()):
+                written = (self.device_io(drive) or (0, start_written))[1] - start_written
+                rate = written / max(time() - started, 0.001) / 1e6
+                done = min(written / total, 1) if total else 0
+                bar = int(done * 20) * '#' + (20 - int(done * 20)) * '-'
+                parts.append(f'{drive} [{bar}] {done:4.0%} {written // MiB} MiB {rate:.1f} MB/s')
+            with self.print_lock:
+                print('\r\033[K' + ' | '.join(parts), end='', flush=True)
+                self.progress_shown = True
+        self.clear_progress()
+
+    def write_prometheus(self):
+        if not(self.prometheus):
+            return
+        with self.lock:
+            lines = []
+            typed = set()
+            for (metric, labels), value in sorted(self.samples.items()):
+                kind = 'gauge' if metric in GAUGE_METRICS else 'counter'
+                metric_name = f"raspi_img2headless_{metric}{'_total' if kind == 'counter' else ''}"
+                if metric_name not in typed:
+                    lines.append(f'# TYPE {metric_name} {kind}')
+                    typed.add(metric_name)
+                label_text = ','.join(f'{name}="{value}"'.replace('\n', ' ') for name, value in labels)
+                lines.append(f'{metric_name}{{{label_text}}} {value}' if label_text else f'{metric_name} {value}')
+            with open(self.prometheus + '.tmp', 'w') as file:
+                file.write('\n'.join(lines) + '\n')
+            rename(self.prometheus + '.tmp', self.prometheus)
+
+    def clear_progress(self):
+        if self.progress_shown:
+            print('\r\033[K', end='', flush=True)
+            self.progress_shown = False
+
+    def finish(self, results):
+        self.add_sample('run_duration_seconds', {}, time() - self.started)
+        self.add_sample('run_failed_targets', {}, sum(1 for error in results.values() if error is not None))
+        self.emit('run', seconds=round(time() - self.started, 3), results={target: error is None for target, error in results.items()})
+        self.write_prometheus()
+        if self.events is not None:
+            self.events.close()
+            self.events = None
+
+class Writeback(object):
+    def __init__(self, fd, limit):
+        self.fd = fd
+        self.window = max(limit // 2, 1)
+        self.current = None
+        self.previous = None
+
+    def written(self, offset, length):
+        if self.current is None:
+            self.current = [offset, offset + length]
+        else:
+            self.current = [min(self.current[0], offset), max(self.current[1], offset + length)]
+        if self.current[1] - self.current[0] >= self.window:
+            sync_file_range(self.fd, self.current[0], self.current[1] - self.current[0], SYNC_FILE_RANGE_WRITE)
+            self.drain()
+            self.previous, self.current = self.current, None
+
+    def drain(self):
+        if self.previous is not None:
+            start, end = self.previous
+            sync_file_range(self.fd, start, end - start, SYNC_FILE_RANGE_WAIT_BEFORE | SYNC_FILE_RANGE_WRITE | SYNC_FILE_RANGE_WAIT_AFTER)
+            posix_fadvise(self.fd, start, end - start, POSIX_FADV_DONTNEED)
+            self.previous = None
+
+    def finish(self):
+        self.drain()
+        if self.current is not None:
+            self.previous, self.current = self.current, None
+            self.drain()
+
+class WriteBudget(object):
+    def __init__(self, limit, flush):
+        self.limit = limit
+        self.flush = flush
+        self.pending = 0
+        self.lock = Lock()
+
+    def add(self, length):
+        with self.lock:
+            self.pending += length
+            if self.pending >= self.limit:
+                self.flush()
+                self.pending = 0
+
+class FatVolume(object):
+    def __init__(self, device, offset=0, flags=O_RDWR):
+        self.device = device
+        self.offset = offset
+        self.lock = Lock()
+        self.fd = os_open(device, flags)
+        geometry = fat_geometry(pread(self.fd, 512, offset))
+        if geometry is None:
+            os_close(self.fd)
+            raise Exception(f'{device} does not contain a FAT filesystem.')
+        if geometry['clusters'] < 4085:
+            os_close(self.fd)
+            raise Exception(f'{device} contains a FAT12 filesystem, which is not supported.')
+        self.sector_size = geometry['sector size']
+        self.cluster_size = geometry['cluster size']
+        self.clusters = geometry['clusters']
+        self.fat_offsets = [offset + fat_offset for fat_offset in geometry['fats']]
+        self.root_region = (offset + geometry['root start'], geometry['root size'])
+        self.data_start = offset + geometry['data start']
+        self.fat32 = geometry['fat32']
+        self.entry_size, self.end_of_chain = (4, 0x0FFFFFFF) if self.fat32 else (2, 0xFFFF)
+        self.root_cluster = geometry['root cluster']
+        self.fsinfo = offset + geometry['fsinfo'] if geometry['fsinfo'] is not None else None
+        self.fat = bytearray(pread(self.fd, geometry['fat size'], self.fat_offsets[0]))
+        self.dirty = None
+        self.written = []
+
+    def write_at(self, data, offset):
+        pwrite_all(self.fd, data, offset)
+        self.written.append((offset, len(data)))
+
+    def next_cluster(self, cluster):
+        if self.fat32:
+            return struct.unpack_from('<I', self.fat, cluster * 4)[0] & 0x0FFFFFFF
+        return struct.unpack_from('<H', self.fat, cluster * 2)[0]
+
+    def set_next_cluster(self, cluster, value):
+        if self.fat32:
+            value |= struct.unpack_from('<I', self.fat, cluster * 4)[0] & 0xF0000000
+        struct.pack_into('<I' if self.fat32 else '<H', self.fat, cluster * self.entry_size, value)
+        start, end = cluster * self.entry_size, (cluster + 1) * self.entry_size
+        self.dirty = (start, end) if self.dirty is None else (min(self.dirty[0], start), max(self.dirty[1], end))
+
+    def chain(self, cluster):
+        clusters = []
+        while 2 <= cluster < self.clusters + 2 and len(clusters) <= self.clusters:
+            clusters.append(cluster)
+            cluster = self.next_cluster(cluster)
+        return clusters
+
+    def cluster_offset(self, cluster):
+        return self.data_start + (cluster - 2) * self.cluster_size
+
+    def regions(self, cluster):
+        if not(cluster):
+            return [self.root_region]
+        return [(self.cluster_offset(cluster), self.cluster_size) for cluster in self.chain(cluster)]
+
+    def allocate(self, count, previous=None):
+        clusters = []
+        for cluster in range(2, self.clusters + 2):
+            if len(clusters) == count:
+                break
+            if not(self.next_cluster(cluster)):
+                clusters.append(cluster)
+        if len(clusters) < count:
+            raise Exception(f'Not enough free space on {self.device}.')
+        for cluster in clusters:
+            if previous is not None:
+                self.set_next_cluster(previous, cluster)
+            previous = cluster
+        if clusters:
+            self.set_next_cluster(clusters[-1], self.end_of_chain)
+        return clusters
+
+    def release(self, clusters):
+        for cluster in clusters:
+            self.set_next_cluster(cluster, 0)
+
+    def entries(self, cluster):
+        long_name = {}
+        for region_offset, region_size in self.regions(cluster):
+            data = pread(self.fd, region_size, region_offset)
+            for position in range(0, region_size, 32):
+                entry = data[position:position + 32]
+                if entry[0] == 0:
+                    return
+                if entry[0] == 0xE5:
+                    long_name = {}
+                    continue
+                if entry[11] == 0x0F:
+                    long_name[entry[0] & 0x1F] = (entry[1:11] + entry[14:26] + entry[28:32], entry[13], region_offset + position)
+                    continue
+                offsets = [value[2] for value in long_name.values()]
+                name = fat_short_name(entry)
+                if long_name and all(value[1] == fat_name_checksum(entry[:11]) for value in long_name.values()):
+                    name = b''.join(long_name[order][0] for order in sorted(long_name)).decode('utf-16-le').split('\x00')[0]
+                long_name = {}
+                if not(entry[11] & 0x08) and name not in ['.', '..']:
+                    yield name, entry, region_offset + position, offsets
+
+    def lookup(self, location):
+        cluster = self.root_cluster
+        entry = None
+        for part in [part for part in location.split('/') if part]:
+            if entry is not None and not(entry[1][11] & 0x10):
+                return None
+            entry = next((found for found in self.entries(cluster) if found[0].lower() == part.lower()), None)
+            if entry is None:
+                return None
+            cluster = fat_first_cluster(entry[1])
+        return entry
+
+    def read(self, location):
+        with self.lock:
+            entry = self.lookup(location)
+            if entry is None or entry[1][11] & 0x10:
+                raise Exception(f'{location} does not exist on {self.device}.')
+            size, = struct.unpack_from('<I', entry[1], 28)
+            if not(fat_first_cluster(entry[1])):
+                return b''
+            data = b''.join(pread(self.fd, length, offset) for offset, length in self.regions(fat_first_cluster(entry[1])))
+            return data[:size]
+
+    def write(self, location, data):
+        with self.lock:
+            directory, name = path.split(location.strip('/'))
+            parent = self.lookup(directory) if directory else None
+            if directory and (parent is None or not(parent[1][11] & 0x10)):
+                raise Exception(f'{directory} does not exist on {self.device}.')
+            parent_cluster = fat_first_cluster(parent[1]) if parent is not None else self.root_cluster
+            entry = self.lookup(location)
+            if entry is not None and entry[1][11] & 0x10:
+                raise Exception(f'{location} is a directory on {self.device}.')
+            clusters = self.chain(fat_first_cluster(entry[1])) if entry is not None else []
+            needed = -(-len(data) // self.cluster_size)
+            if needed < len(clusters):
+                self.release(clusters[needed:])
+                clusters = clusters[:needed]
+                if clusters:
+                    self.set_next_cluster(clusters[-1], self.end_of_chain)
+            elif needed > len(clusters):
+                clusters += self.allocate(needed - len(clusters), clusters[-1] if clusters else None)
+            for number, cluster in enumerate(clusters):
+                part = data[number * self.cluster_size:(number + 1) * self.cluster_size]
+                self.write_at(part + bytes(self.cluster_size - len(part)), self.cluster_offset(cluster))
+            first = clusters[0] if clusters else 0
+            if entry is None:
+                self.create_entry(parent_cluster, name, first, len(data))
+            else:
+                updated = bytearray(entry[1])
+                struct.pack_into('<H', updated, 20, first >> 16)
+                struct.pack_into('<HHHI', updated, 22, *fat_timestamp(), first & 0xFFFF, len(data))
+                updated[11] |= 0x20
+                self.write_at(bytes(updated), entry[2])
+            self.flush()
+
+    def create_entry(self, cluster, name, first, size):
+        short_names = [entry[1][:11] for entry in self.entries(cluster)]
+        short, long_needed = fat_83_name(name, short_names)
+        entry = bytearray(short + bytes(21))
+        entry[11] = 0x20
+        struct.pack_into('<HHH', entry, 14, *fat_timestamp(), fat_timestamp()[1])
+        struct.pack_into('<H', entry, 20, first >> 16)
+        struct.pack_into('<HHHI', entry, 22, *fat_timestamp(), first & 0xFFFF, size)
+        slots = [bytes(entry)]
+        if long_needed:
+            encoded = name.encode('utf-16-le')
+            if len(encoded) % 26:
+                encoded += b'\x00\x00'
+                encoded += b'\xff' * (-len(encoded) % 26)
+            checksum = fat_name_checksum(short)
+            parts = [encoded[pos:pos + 26] for pos in range(0, len(encoded), 26)]
+            for order, part in enumerate(parts, start=1):
+                sequence = order | (0x40 if order == len(parts) else 0)
+                slots.insert(0, bytes([sequence]) + part[:10] + bytes([0x0F, 0, checksum]) + part[10:22] + b'\x00\x00' + part[22:26])
+        offsets = self.free_slots(cluster, len(slots))
+        for offset, slot in zip(offsets, slots):
+            self.write_at(slot, offset)
+
+    def free_slots(self, cluster, count):
+        while True:
+            run = []
+            for region_offset, region_size in self.regions(cluster):
+                data = pread(self.fd, region_size, region_offset)
+                for position in range(0, region_size, 32):
+                    if data[position] in [0, 0xE5]:
+                        run.append(region_offset + position)
+                        if len(run) == count:
+                            return run
+                    else:
+                        run = []
+            if not(cluster):
+                raise Exception(f'The root directory of {self.device} is full.')
+            added = self.allocate(1, self.chain(cluster)[-1])[0]
+            self.write_at(bytes(self.cluster_size), self.cluster_offset(added))
+
+    def flush(self):
+        if self.dirty is not None:
+            start = self.dirty[0] // self.sector_size * self.sector_size
+            end = -(-self.dirty[1] // self.sector_size) * self.sector_size
+            for fat_offset in self.fat_offsets:
+                self.write_at(bytes(self.fat[start:end]), fat_offset + start)
+            if self.fsinfo is not None:
+                self.write_at(b'\xff' * 8, self.fsinfo + 488)
+            self.dirty = None
+        fsync(self.fd)
+
+    def close(self):
+        fsync(self.fd)
+        os_close(self.fd)
+
+class Ext4Volume(object):
+    def __init__(self, device, offset=0, flags=O_RDWR):
+        self.device = device
+        self.offset = offset
+        self.lock = Lock()
+        self.fd = os_open(device, flags)
+        superblock = pread(self.fd, 1024, offset + 1024)
+        geometry = ext4_geometry(superblock)
+        if geometry is None:
+            os_close(self.fd)
+            raise Exception(f'{device} does not contain an ext4 filesystem.')
+        if geometry['incompat'] & 0x4:
+            os_close(self.fd)
+            raise Exception(f'The journal of {device} needs to be recovered first.')
+        self.inodes_per_group = geometry['inodes per group']
+        self.inode_size = geometry['inode size']
+        self.block_size = geometry['block size']
+        self.desc_size = geometry['descriptor size']
+        self.descriptors = offset + geometry['descriptors']
+        self.metadata_csum = bool(geometry['ro compat'] & 0x400)
+        if geometry['incompat'] & 0x2000:
+            self.checksum_seed, = struct.unpack_from('<I', superblock, 0x270)
+        else:
+            self.checksum_seed = crc32c(0xFFFFFFFF, superblock[0x68:0x78])
+        self.written = []
+
+    def write_at(self, data, offset):
+        pwrite_all(self.fd, data, offset)
+        self.written.append((offset, len(data)))
+
+    def inode_offset(self, number):
+        group, index = divmod(number - 1, self.inodes_per_group)
+        descriptor = pread(self.fd, self.desc_size, self.descriptors + group * self.desc_size)
+        table = ext4_descriptor(descriptor, 0, self.desc_size)['inode table']
+        return self.offset + table * self.block_size + index * self.inode_size
+
+    def read_inode(self, number):
+        offset = self.inode_offset(number)
+        return bytearray(pread(self.fd, self.inode_size, offset)), offset
+
+    def block_map(self, inode, nodes=None):
+        flags, = struct.unpack_from('<I', inode, 0x20)
+        if flags & 0x10000000:
+            return None
+        if flags & 0x80000:
+            return self.extent_map(bytes(inode[0x28:0x64]), nodes)
+        mapping = []
+        pointers = struct.unpack_from('<15I', inode, 0x28)
+        for logical, block in enumerate(pointers[:12]):
+            if block:
+                mapping.append((logical, block, 1, True))
+        per_block = self.block_size // 4
+        logical = 12
+        for depth, block in enumerate(pointers[12:], start=1):
+            mapping += self.indirect_map(block, depth, logical, nodes)
+            logical += per_block ** depth
+        return mapping
+
+    def indirect_map(self, block, depth, logical, nodes=None):
+        per_block = self.block_size // 4
+        if not(block):
+            return []
+        if nodes is not None:
+            nodes.append(block)
+        pointers = struct.unpack(f'<{per_block}I', pread(self.fd, self.block_size, self.offset + block * self.block_size))
+        mapping = []
+        for number, pointer in enumerate(pointers):
+            if depth == 1:
+                if pointer:
+                    mapping.append((logical + number, pointer, 1, True))
+            else:
+                mapping += self.indirect_map(pointer, depth - 1, logical + number * per_block ** (depth - 1), nodes)
+        return mapping
+
+    def extent_map(self, node, nodes=None):
+        magic, entries, maximum, depth = struct.unpack_from('<HHHH', node, 0)
+        if magic != 0xF30A:
+            raise Exception(f'Corrupt extent tree on {self.device}.')
+        mapping = []
+        for number in range(entries):
+            position = 12 + number * 12
+            if depth:
+                leaf_lo, leaf_hi = struct.unpack_from('<IH', node, position + 4)
+                if nodes is not None:
+                    nodes.append((leaf_hi << 32) | leaf_lo)
+                leaf = pread(self.fd, self.block_size, self.offset + ((leaf_hi << 32) | leaf_lo) * self.block_size)
+                mapping += self.extent_map(leaf, nodes)
+            else:
+                logical, length, start_hi, start_lo = struct.unpack_from('<IHHI', node, position)
+                initialized = length <= 32768
+                mapping.append((logical, (start_hi << 32) | start_lo, length if initialized else length - 32768, initialized))
+        return mapping
+
+    def inode_ranges(self, number):
+        inode, offset = self.read_inode(number)
+        nodes = []
+        mapping = self.block_map(inode, nodes) or []
+        ranges = [(offset, self.inode_size)] + [(self.offset + block * self.block_size, self.block_size) for block in nodes]
+        return ranges + [(self.offset + physical * self.block_size, length * self.block_size) for logical, physical, length, initialized in mapping]
+
+    def metadata_ranges(self):
+        geometry = ext4_geometry(pread(self.fd, 1024, self.offset + 1024))
+        descriptors = pread(self.fd, geometry['groups'] * self.desc_size, self.descriptors)
+        ranges = [(0, (geometry['first data block'] + 1) * self.block_size)] + ext4_metadata_ranges(geometry, descriptors)
+        return [(self.offset + offset, length) for offset, length in ranges] + self.inode_ranges(7)
+
+    def inode_data(self, inode):
+        size = struct.unpack_from('<I', inode, 0x4)[0] | struct.unpack_from('<I', inode, 0x6C)[0] << 32
+        mapping = self.block_map(inode)
+        if mapping is None:
+            return bytes(inode[0x28:0x64])[:size]
+        data = bytearray(size)
+        for logical, physical, length, initialized in mapping:
+            start = logical * self.block_size
+            if initialized and start < size:
+                data[start:start + length * self.block_size] = pread(self.fd, min(length * self.block_size, size - start), self.offset + physical * self.block_size)
+        return bytes(data[:size])
+
+    def lookup(self, location):
+        number = 2
+        for part in [part for part in location.split('/') if part]:
+            inode, offset = self.read_inode(number)
+            if struct.unpack_from('<H', inode, 0)[0] & 0xF000 != 0x4000:
+                return None
+            data = self.inode_data(inode)
+            position = 4 if self.block_map(inode) is None else 0
+            number = None
+            while position + 8 <= len(data):
+                entry_inode, record_length, name_length = struct.unpack_from('<IHB', data, position)
+                if entry_inode and data[position + 8:position + 8 + name_length] == part.encode():
+                    number = entry_inode
+                    break
+                if record_length < 8:
+                    break
+                position += record_length
+            if number is None:
+                return None
+        return number
+
+    def read(self, location):
+        with self.lock:
+            number = self.lookup(location)
+            if number is None:
+                raise Exception(f'{location} does not exist on {self.device}.')
+            return self.inode_data(self.read_inode(number)[0])
+
+    def write(self, location, data):
+        with self.lock:
+            number = self.lookup(location)
+            if number is None or not(self.write_in_place(number, data)):
+                self.write_debugfs(location, number, data)
+            fsync(self.fd)
+
+    def write_in_place(self, number, data):
+        inode, offset = self.read_inode(number)
+        if struct.unpack_from('<H', inode, 0)[0] & 0xF000 != 0x8000:
+            return False
+        mapping = self.block_map(inode)
+        needed = -(-len(data) // self.block_size)
+        if not(mapping) or not(all(initialized for logical, physical, length, initialized in mapping)):
+            return False
+        blocks = {}
+        for logical, physical, length, initialized in mapping:
+            for block in range(length):
+                blocks[logical + block] = physical + block
+        if sorted(blocks) != list(range(needed)):
+            return False
+        for logical in range(needed):
+            part = data[logical * self.block_size:(logical + 1) * self.block_size]
+            self.write_at(part + bytes(self.block_size - len(part)), self.offset + blocks[logical] * self.block_size)
+        now = int(time())
+        struct.pack_into('<I', inode, 0x4, len(data) & 0xFFFFFFFF)
+        struct.pack_into('<I', inode, 0x6C, len(data) >> 32)
+        struct.pack_into('<II', inode, 0x0C, now, now)
+        extra_size = struct.unpack_from('<H', inode, 0x80)[0] if self.inode_size > 128 else 0
+        if extra_size >= 0x0C:
+            struct.pack_into('<II', inode, 0x84, 0, 0)
+        if self.metadata_csum:
+            struct.pack_into('<H', inode, 0x7C, 0)
+            if extra_size >= 4:
+                struct.pack_into('<H', inode, 0x82, 0)
+            generation = inode[0x64:0x68]
+            checksum = crc32c(crc32c(crc32c(self.checksum_seed, struct.pack('<I', number)), generation), inode)
+            struct.pack_into('<H', inode, 0x7C, checksum & 0xFFFF)
+            if extra_size >= 4:
+                struct.pack_into('<H', inode, 0x82, checksum >> 16)
+        self.write_at(bytes(inode), offset)
+        return True
+
+    def write_debugfs(self, location, number, data):
+        location = '/' + location.strip('/')
+        commands = []
+        if number is not None:
+            inode = self.read_inode(number)[0]
+            mode, uid = struct.unpack_from('<HH', inode, 0)
+            gid, = struct.unpack_from('<H', inode, 0x18)
+            uid_high, gid_high = struct.unpack_from('<HH', inode, 0x78)
+            uid, gid = uid | uid_high << 16, gid | gid_high << 16
+            commands.append(f'rm {location}')
+        else:
+            mode, uid, gid = 0o100644, 0, 0
+        fsync(self.fd)
+        with tempfile.NamedTemporaryFile() as contents, tempfile.NamedTemporaryFile('w') as script:
+            contents.write(data)
+            contents.flush()
+            commands += [
+                f'write {contents.name} {location}',
+                f'sif {location} mode 0{mode:o}',
+                f'sif {location} uid {uid}',
+                f'sif {location} gid {gid}',
+            ]
+            script.write('\n'.join(commands) + '\n')
+            script.flush()
+            device = f'{self.device}?offset={self.offset}' if self.offset else self.device
+            task = subprocess.run(['debugfs', '-w', '-f', script.name, device], stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+            output = task.stdout.decode()
+            if task.returncode != 0 or self.lookup(location) is None:
+                raise Exception(f'debugfs could not write {location} on {self.device}.', *output.strip('\n').split('\n'))
+        if number is not None:
+            self.written.append((self.inode_offset(number), self.inode_size))
+        self.written += self.inode_ranges(self.lookup(location)) + self.inode_ranges(self.lookup(path.dirname(location)))
+
+    def close(self):
+        fsync(self.fd)
+        os_close(self.fd)
+
+class Runner(object):
+    def __init__(self, instrumentation):
+        self.instrumentation = instrumentation
+
+    def run(self, target, command):
+        task = subprocess.Popen(command , shell=True, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        self.instrumentation.run_command(target, command, task)
+        return [task.returncode == 0, [line.decode('utf-8').strip('\n') for line in task.stdout.readlines()]]
+
+    def call(self, target, label, function, *arguments, **keywords):
+        return function(*arguments, **keywords)
+
+    def read(self, target, filelocation, function):
+        return function(filelocation)
+
+    def write(self, target, filelocation, content, function):
+        function(filelocation, content)
+
+    def path(self, location):
+        return location
+
+    def summary(self):
+        return None
+
+class RecordingRunner(Runner):
+    def __init__(self, instrumentation, file):
+        super().__init__(instrumentation)
+        self.lock = Lock()
+        self.file = open(file, 'w')
+
+    def capture(self, kind, target, key, function, *arguments, **keywords):
+        started = time()
+        entry = {'kind': kind, 'target': target, 'key': key}
+        try:
+            entry['result'] = function(*arguments, **keywords)
+            return entry['result']
+        except Exception as e:
+            entry['error'] = [str(arg) for arg in e.args]
+            raise
+        finally:
+            entry['seconds'] = round(time() - started, 6)
+            with self.lock:
+                self.file.write(json.dumps(entry, default=str) + '\n')
+                self.file.flush()
+
+    def run(self, target, command):
+        return self.capture('run', target, command, super().run, target, command)
+
+    def call(self, target, label, function, *arguments, **keywords):
+        return self.capture('call', target, label, function, *arguments, **keywords)
+
+    def read(self, target, filelocation, function):
+        return self.capture('read', target, filelocation, function, filelocation)
+
+    def write(self, target, filelocation, content, function):
+        return self.capture('write', target, filelocation, function, filelocation, content)
+
+    def summary(self):
+        return f'Commands and results recorded in {self.file.name}.'
+
+class ReplayRunner(Runner):
+    def __init__(self, instrumentation, file):
+        super().__init__(instrumentation)
+        self.lock = Lock()
+        self.entries = {}
+        self.unrecorded = 0
+        with open(file, 'r') as recording:
+            for line in recording:
+                entry = json.loads(line)
+                self.entries.setdefault((entry['kind'], entry['target'], entry['key']), []).append(entry)
+        self.directory = tempfile.mkdtemp(prefix='raspi-img2headless-replay-')
+
+    def replayed(self, kind, target, key):
+        with self.lock:
+            entries = self.entries.get((kind, target, key))
+            if not(entries):
+                if kind == 'run':
+                    self.unrecorded += 1
+                    return None
+                raise Exception(f'{key} is not in the recording.')
+            entry = entries.pop(0) if len(entries) > 1 else entries[0]
+        if 'error' in entry:
+            raise Exception(*entry['error'])
+        return entry
+
+    def run(self, target, command):
+        entry = self.replayed('run', target, command) or {'result': [True, []], 'seconds': 0}
+        self.instrumentation.emit('command', target=target, command=command, returncode=0 if entry['result'][0] else 1, seconds=entry['seconds'], replayed=True)
+        return entry['result']
+
+    def call(self, target, label, function, *arguments, **keywords):
+        return self.replayed('call', target, label)['result']
+
+    def read(self, target, filelocation, function):
+        replayed = self.path(filelocation)
+        if not(path.exists(replayed)):
+            content = self.replayed('read', target, filelocation)['result']
+            makedirs(path.dirname(replayed), exist_ok=True)
+            with open(replayed, 'w') as file:
+                file.write(''.join(content))
+        with open(replayed, 'r') as file:
+            return file.readlines()
+
+    def write(self, target, filelocation, content, function):
+        replayed = self.path(filelocation)
+        makedirs(path.dirname(replayed), exist_ok=True)
+        write_lines(replayed, content)
+
+    def path(self, location):
+        return path.join(self.directory, location.lstrip('/'))
+
+    def summary(self):
+        return f'Replayed run written to {self.directory}, {self.unrecorded} commands were not in the recording.'
+
+class StoreReader(object):
+    def __init__(self, image, depth=4):
+        self.manifest = load_manifest(image)
+        self.chunks = path.join(path.dirname(path.dirname(image[len(STORE_PREFIX):])), 'chunks')
+        self.offsets = [0] + list(accumulate(length for digest, length in self.manifest['chunks']))
+        self.depth = depth
+        self.queue = None
+        self.thread = None
+        self.stop = Event()
+        self.current = b''
+
+    def chunk_file(self, digest):
+        return f'{self.chunks}/{digest[:2]}/{digest}'
+
+    def load(self, number):
+        digest, length = self.manifest['chunks'][number]
+        if digest is None:
+            return bytes(length)
+        with open(self.chunk_file(digest), 'rb', buffering=0) as file:
+            data = read_chunk(file, length)
+        if len(data) != length:
+            raise Exception(f'Chunk {digest} of the image store is incomplete.')
+        return data
+
+    def put(self, item):
+        while not(self.stop.is_set()):
+            try:
+                self.queue.put(item, timeout=0.1)
+                return
+            except Full:
+                continue
+
+    def prefetch(self):
+        try:
+            for number in range(len(self.manifest['chunks'])):
+                if self.stop.is_set():
+                    return
+                self.put(self.load(number))
+            self.put(b'')
+        except Exception as e:
+            self.put(e)
+
+    def read(self, size=-1):
+        if self.queue is None:
+            self.queue = Queue(self.depth)
+            self.thread = Thread(target=self.prefetch, daemon=True)
+            self.thread.start()
+        if not(self.current):
+            self.current = self.queue.get()
+            if isinstance(self.current, Exception):
+                raise self.current
+        size = len(self.current) if size < 0 else size
+        data, self.current = self.current[:size], self.current[size:]
+        return data
+
+    def read_at(self, length, offset):
+        data = []
+        number = bisect_right(self.offsets, offset) - 1
+        while length > 0 and number < len(self.manifest['chunks']):
+            start = offset - self.offsets[number]
+            part = self.load(number)[start:start + length]
+            data.append(part)
+            offset += len(part)
+            length -= len(part)
+            number += 1
+        return b''.join(data)
+
+    def close(self):
+        self.stop.set()
+        if self.thread is not None:
+            while not(self.queue.empty()):
+                self.queue.get()
+            self.thread.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *arguments):
+        self.close()
+
+class Journal(object):
+    def __init__(self, file):
+        self.file = file
+        self.lock = Lock()
+        self.entries = {}
+        if path.exists(file):
+            with open(file, 'r') as journal:
+                self.entries = json.load(journal)
+
+    def done(self, step):
+        return self.entries.get(step, {}).get('finished') is not None
+
+    def state(self, step, key, default=None):
+        return self.entries.get(step, {}).get(key, default)
+
+    def record(self, step, **state):
+        with self.lock:
+            self.entries.setdefault(step, {}).update(state)
+            makedirs(path.dirname(self.file), exist_ok=True)
+            with open(self.file + '.tmp', 'w') as journal:
+                json.dump(self.entries, journal, indent=1)
+            rename(self.file + '.tmp', self.file)
+
+    def clear(self):
+        with self.lock:
+            self.entries = {}
+            if path.exists(self.file):
+                remove(self.file)
 
 class Imager(object):
     def __init__(self):
+        self.print_lock = Lock()
+        self.instrumentation = Instrumentation(self.print_lock, self.get_option('events'), self.get_option('prometheus'), stdout.isatty() and not(self.get_option('no-progress')))
         self.init_messages()
+        self.runner = self.init_runner()
         self.check_privileges()
         self.init_settings()
+        if self.get_option('daemon'):
+            self.load_settings(self.get_option('daemon'))
+            self.show_settings()
+            self.execute_daemon()
+            return
+        if self.get_option('import'):
+            self.exception_handler(self.import_to_store, 37)
+            return
         self.selection_loop()
         self.execute_workflow()
 
     def execute_workflow(self):
+        self.exception_handler(self.load_image_index, 36)
+        if self.settings['Dry run']:
+            self.show_plan()
+            return
         self.perform_cleanup()
-        self.create_partition_table()
-        self.format_partitions()
-        self.prepare_target()
-        self.mount_copy_image()
-        if self.settings['Activate SSH']:
-            self.exception_handler(self.activate_ssh, 5)
-        if self.settings['Activate wifi']:
-            self.exception_handler(self.activate_wifi, 6)
-        self.exception_handler(self.set_root, 7)
-        self.exception_handler(self.modify_fstab, 8)
-        if self.settings['Modify hostname']:
-            self.exception_handler(self.modify_hostname, 9)
+        if self.settings['Image cache'] != 'not set':
+            self.exception_handler(self.prepare_golden_image, 14)
+        if self.settings['Copy mode'] == 'stream':
+            results = self.stream_targets()
+        else:
+            self.exception_handler(self.attach_image, 10)
+            results = self.provision_targets()
         self.perform_cleanup()
+        self.instrumentation.finish(results)
+        if self.runner.summary() is not None:
+            self.output(self.runner.summary())
+        self.report_results(results)
+
+    def init_runner(self):
+        if self.get_option('record') and self.get_option('replay'):
+            self.error_quit('Error: ' + self.error_messages[20])
+        if self.get_option('replay'):
+            return ReplayRunner(self.instrumentation, self.get_option('replay'))
+        if self.get_option('record'):
+            return RecordingRunner(self.instrumentation, self.get_option('record'))
+        return Runner(self.instrumentation)
 
     def check_privileges(self):
-        if getuid() != 0:
+        if getuid() != 0 and not(self.get_option('replay')):
                 self.error_quit('Error: ' + self.error_messages[21])
 
     def init_messages(self):
         self.input_messages = {
-            0: 'Select the drive you want to install the image to.',
+            0: 'Select the drives you want to install the image to.',
             1: 'Enter number or [c]ancel: ',
             2: 'Do you want to enable SSH after installation?',
             3: 'Do you want to enable wifi after installation?',
@@ -61,59 +1041,119 @@ class Imager(object):
             5: 'SSID of your wifi network',
             6: 'password of your wifi network',
             7: 'Do you want to set the hostname for your pi?',
-            8: 'hostname of your pi',
+            8: 'hostname of your pi ({n} is replaced by the number of the drive)',
             9: 'Please confirm the above settings.\nPLEASE NOTE: SELECTED DRIVE WILL BE DELETED AND ALL DATA WILL BE LOST.\nProceed? ',
             10: 'Which value would you like to change?',
+            11: 'Enter numbers separated by commas, [a]ll or [c]ancel: ',
 
         }
         self.status_messages = {
             0: 'Initiating cleanup.',
             1: 'Creating partition table.',
-            2: 'Formatting partitions.',
+            2: 'Formatting boot partition.',
             3: 'Preparing target for copy.',
-            4: 'Mounting image and copying to target.',
+            4: 'Copying root filesystem to target.',
             5: 'Creating file that activates SSH on first boot.',
             6: 'Creating wifi settings.',
             7: 'Adapting root in boot file cmdline.txt.',
             8: 'Modifying fstab.',
             9: 'Setting new hostname.',
+            10: 'Attaching and mounting image.',
+            11: 'Copying used blocks of the root partition.',
+            12: 'Growing root filesystem.',
+            13: 'Streaming image to targets.',
+            14: 'Preparing cached customized image.',
+            15: 'Formatting root partition.',
+            16: 'Copying boot filesystem to target.',
+            17: 'Copying used blocks of the boot partition.',
+            18: 'Deriving wifi key.',
+            19: 'Completed in a previous run, skipping step:',
             20: 'Script stopped on user input.',
             21: 'The following settings have been set.',
+            22: 'Results per drive:',
+            30: 'Probing the real capacity of the drive.',
+            31: 'Verifying boot partition.',
+            32: 'Verifying root partition.',
+            33: 'Verifying written image.',
+            34: 'Indexing written blocks for delta updates.',
+            35: 'Discarding drive.',
+            36: 'Inspecting image.',
+            37: 'Importing image into the image store.',
         }
         self.error_messages = {
             0: 'There was an error during cleanup.',
             1: 'There was an error creating the partition table.',
-            2: 'There was an error formatting the partitions.',
+            2: 'There was an error formatting the boot partition.',
             3: 'There was an error preparing the target.',
-            4: 'There was an error during copying.',
+            4: 'There was an error copying the root filesystem.',
             5: 'There was an error while creating the file to activate SSH.',
             6: 'There was an error creating wifi settings.',
             7: 'There was an error while adapting boot file cmdline.txt.',
             8: 'There was an error while modifying fstab.',
             9: 'There was an error setting the hostname.',
-            20: 'Usage: raspi-img2headless.py <path-to-image>',
+            10: 'There was an error attaching the image.',
+            11: 'There was an error copying the root partition.',
+            12: 'There was an error growing the root filesystem.',
+            13: 'There was an error streaming the image.',
+            14: 'There was an error preparing the cached customized image.',
+            15: 'There was an error formatting the root partition.',
+            16: 'There was an error copying the boot filesystem.',
+            17: 'There was an error copying the boot partition.',
+            18: 'There was an error deriving the wifi key.',
+            20: 'Usage: raspi-img2headless.py <path-to-image> [--workers=<number>] [--copy=file|block|stream] [--cache[=<directory>]] [--cache-size=<size>] [--journal=<directory>] [--restart] [--verify] [--delta[=<directory>]] [--events=<file>] [--prometheus=<file>] [--no-progress] [--settings=<file>] [--copier=native|rsync] [--max-inflight=<size>] [--mount] [--index=<directory>] [--dry-run] [--store=<directory>] [--import [--name=<name>]] [--daemon=<profile>] [--work=<directory>] [--record=<file>|--replay=<file>]',
             21: 'Insufficient access rights.\nRun as root or by using sudo.',
             22: 'Input could not be recognized.',
+            23: 'Provisioning failed for: ',
+            24: 'Compressed images can only be copied with --copy=stream.',
+            25: 'The image cache can only be used with --copy=stream.',
+            26: 'Delta updates can only be used with --copy=stream.',
+            27: 'Settings file could not be read.',
+            28: 'Stored images can only be copied with --copy=stream.',
+            29: 'The image is not in the image store.',
+            30: 'The drive failed the capacity probe.',
+            31: 'The boot partition failed verification.',
+            32: 'The root partition failed verification.',
+            33: 'There was an error verifying the written image.',
+            34: 'There was an error indexing the written blocks.',
+            35: 'There was an error discarding the drive.',
+            36: 'There was an error inspecting the image.',
+            37: 'There was an error importing the image into the image store.',
         }
         self.confirmation_messages = {
             0: 'Cleanup finished successful.',
             1: 'Partition table created.',
-            2: 'Partitions formatted.',
+            2: 'Boot partition formatted.',
             3: 'Target successfully prepared.',
-            4: 'Image copied to target.',
+            4: 'Root filesystem copied to target.',
             5: 'File created. SSH will be activated on first boot.',
             6: 'Wifi settings successfully created.',
             7: 'Root set successful in boot file cmdline.txt.',
             8: 'Modification of fstab successful.',
             9: 'New hostname successfully set.',
+            10: 'Image attached and mounted.',
+            11: 'Root partition copied.',
+            12: 'Root filesystem grown to the size of the partition.',
+            13: 'Image streamed to targets.',
+            14: 'Cached customized image ready.',
+            15: 'Root partition formatted.',
+            16: 'Boot filesystem copied to target.',
+            17: 'Boot partition copied.',
+            18: 'Wifi key derived.',
+            22: 'successful',
+            30: 'Capacity probe passed.',
+            31: 'Boot partition verified.',
+            32: 'Root partition verified.',
+            33: 'Written image verified.',
+            34: 'Block index saved.',
+            35: 'Drive discarded.',
+            36: 'Image inspected.',
+            37: 'Image imported into the image store.',
         }
 
     def init_settings(self):
         self.settings = {
             'Image path': self.set_image_path(),
             'Target': 'not set',
-            'Target boot': 'not set',
-            'Target root': 'not set',
             'Activate SSH': False,
             'Activate wifi': False,
             'Wifi country': 'not set',
@@ -122,9 +1162,32 @@ class Imager(object):
             'Modify hostname': False,
             'Hostname entered': 'not set',
         }
+        self.settings['Image cache'] = self.set_image_cache()
+        self.settings['Delta index'] = self.set_delta_index()
+        self.settings['Copy mode'] = self.set_copy_mode()
+        self.settings['Verify writes'] = bool(self.get_option('verify', False))
+        self.settings['Mount targets'] = bool(self.get_option('mount', False))
+        self.settings['Image index'] = self.get_option('index', '/var/cache/raspi-img2headless/index')
+        self.settings['Dry run'] = bool(self.get_option('dry-run', False))
+        self.settings['File copier'] = self.get_option('copier', 'native')
+        if self.settings['File copier'] not in ['native', 'rsync']:
+            self.error_quit('Error: ' + self.error_messages[20])
+        try:
+            self.max_inflight = max(parse_size(self.get_option('max-inflight', MAX_INFLIGHT)), 2 * CHUNK_SIZE)
+        except ValueError:
+            self.error_quit('Error: ' + self.error_messages[20])
         self.hidden_settings = {
             'Wifi password': 'not set',
         }
+        work = self.get_option('work', '/tmp')
+        self.paths = {
+            'Source': f'{work}/src',
+            'Target': f'{work}/trgt',
+        }
+        self.source = {}
+        self.rules = []
+        self.index = None
+        self.attached_loops = []
         self.to_change = {
             'Target': True,
             'SSH activation': True,
@@ -137,6 +1200,11 @@ class Imager(object):
         }
 
     def selection_loop(self):
+        settings_file = self.get_option('settings')
+        if settings_file is not None:
+            self.load_settings(settings_file)
+            self.show_settings()
+            return
         while True:
             self.change_settings()
             self.show_settings()
@@ -152,14 +1220,99 @@ class Imager(object):
             else:
                 self.to_change[to_change] = True
 
-    def set_image_path(self):
+    def load_settings(self, settings_file):
         try:
-            app, image_path = argv
-        except Exception as e:
-            self.error_quit('\n'.join(e.args) + '\nError: ' + self.error_messages[20])
+            with open(settings_file, 'r') as file:
+                loaded = json.load(file)
+            for key, value in loaded.items():
+                if key == 'Wifi password':
+                    self.hidden_settings['Wifi password'] = str(value)
+                    self.settings['Wifi password (hidden)'] = len(str(value)) * '*'
+                elif key == 'Target':
+                    self.settings['Target'] = [value] if isinstance(value, str) else list(value)
+                elif key in ['Activate SSH', 'Activate wifi', 'Modify hostname']:
+                    self.settings[key] = bool(value)
+                elif key in ['Wifi country', 'Wifi SSID', 'Hostname entered']:
+                    self.settings[key] = str(value)
+                elif key == 'Rules' and self.get_option('daemon'):
+                    self.rules = [self.load_rule(rule) for rule in value]
+                else:
+                    raise ValueError(f'Unknown setting {key}.')
+        except (OSError, ValueError, TypeError, AttributeError) as e:
+            self.error_quit(str(e) + '\nError: ' + self.error_messages[27])
+        if self.get_option('daemon'):
+            if not(self.rules):
+                self.error_quit('No rules set.\nError: ' + self.error_messages[27])
+        elif not(isinstance(self.settings['Target'], list)) or not(self.settings['Target']):
+            self.error_quit('No target set.\nError: ' + self.error_messages[27])
+
+    def load_rule(self, rule):
+        if any(key not in RULE_KEYS for key in rule):
+            raise ValueError(f"Unknown rule key {', '.join(key for key in rule if key not in RULE_KEYS)}.")
+        rule = dict(rule)
+        for key in ['Minimum size', 'Maximum size']:
+            if key in rule:
+                rule[key] = parse_size(str(rule[key]))
+        return rule
+
+    def get_option(self, name, default=None):
+        for argument in argv[1:]:
+            if argument == f'--{name}':
+                return True
+            if argument.startswith(f'--{name}='):
+                return argument.split('=', 1)[1]
+        return default
+
+    def set_image_path(self):
+        arguments = [argument for argument in argv[1:] if not argument.startswith('--')]
+        if len(arguments) != 1:
+            self.error_quit('Error: ' + self.error_messages[20])
+        image_path = arguments[0]
+        if is_stored(image_path):
+            image_path = f"{STORE_PREFIX}{self.store_directory()}/images/{image_path[len(STORE_PREFIX):]}.json"
+            if self.get_option('import') or not(path.exists(image_path[len(STORE_PREFIX):])):
+                self.error_quit('Error: ' + self.error_messages[29])
+            return image_path
         image_path = f'{getcwd()}/{image_path}' if image_path[0] != '/' else image_path
         return image_path
 
+    def store_directory(self):
+        return self.get_option('store', '/var/lib/raspi-img2headless/store')
+
+    def set_copy_mode(self):
+        compressed = is_compressed(self.settings['Image path'])
+        stored = is_stored(self.settings['Image path'])
+        cached = self.settings['Image cache'] != 'not set'
+        delta = self.settings['Delta index'] != 'not set'
+        copy_mode = self.get_option('copy', 'stream' if compressed or stored or cached or delta else 'file')
+        if copy_mode not in ['file', 'block', 'stream']:
+            self.error_quit('Error: ' + self.error_messages[20])
+        if compressed and copy_mode != 'stream':
+            self.error_quit('Error: ' + self.error_messages[24])
+        if stored and copy_mode != 'stream':
+            self.error_quit('Error: ' + self.error_messages[28])
+        if cached and copy_mode != 'stream':
+            self.error_quit('Error: ' + self.error_messages[25])
+        if delta and copy_mode != 'stream':
+            self.error_quit('Error: ' + self.error_messages[26])
+        return copy_mode
+
+    def set_delta_index(self):
+        delta = self.get_option('delta')
+        if delta is None:
+            return 'not set'
+        return '/var/lib/raspi-img2headless/delta' if delta is True else delta
+
+    def set_image_cache(self):
+        cache = self.get_option('cache')
+        if cache is None:
+            return 'not set'
+        try:
+            self.cache_size = parse_size(self.get_option('cache-size', '32G'))
+        except ValueError:
+            self.error_quit('Error: ' + self.error_messages[20])
+        return '/var/cache/raspi-img2headless' if cache is True else cache
+
     def make_selection(self, options, message):
         options_dict = {}
         options_list = []
@@ -188,16 +1341,55 @@ class Imager(object):
             if error_occured:
                 print('Error: ' + '\n' + self.error_messages[22])
 
+    def make_multi_selection(self, options, message, descriptions=None):
+        output = f'{message}'
+        for pos, option in enumerate(options):
+            output += (f'\n[{str(pos)}]\t{option}')
+            if descriptions is not None:
+                output += f'\t{descriptions[pos]}'
+        while True:
+            print(output)
+            selection = input(self.input_messages[11])
+            print('')
+            if selection.lower() == 'c':
+                print('Info: ' + self.status_messages[20])
+                quit()
+            elif selection.lower() == 'a':
+                return list(options)
+            try:
+                positions = [int(part) for part in selection.replace(',', ' ').split()]
+                if positions and all(0 <= pos < len(options) for pos in positions):
+                    return [options[pos] for pos in dict.fromkeys(positions)]
+            except ValueError as e:
+                pass
+            print('Error: ' + '\n' + self.error_messages[22])
+
     def get_drives(self):
-        command = subprocess.run('lsblk -d -o NAME', stderr=subprocess.PIPE, stdout = subprocess.PIPE, stdin = subprocess.PIPE, shell=True)
-        output = command.stdout.decode().split('\n')[:-1]
-        drives = output[1:]
-        return drives
+        return [drive for drive in block_devices() if block_device_info(drive)['size'] and target_drive(drive)]
 
-    def select_drive(self):
+    def select_drives(self):
         drives = self.get_drives()
-        selected_drive = self.make_selection(drives, self.input_messages[0])
-        return selected_drive
+        descriptions = []
+        for drive in drives:
+            info = block_device_info(drive)
+            description = f"{info['size'] / 1e9:.1f} GB"
+            if info['removable']:
+                description += ' removable'
+            descriptions.append(' '.join(part for part in [description, info['model'], info['serial']] if part))
+        selected_drives = self.make_multi_selection(drives, self.input_messages[0], descriptions)
+        return selected_drives
+
+    def partition_names(self, drive, numbers=(1, 2)):
+        prefix = drive + 'p' if drive[-1] in [str(digit) for digit in range(10)] else drive
+        return tuple(f'{prefix}{number}' for number in numbers)
+
+    def target_hostname(self, number):
+        hostname = self.settings['Hostname entered']
+        if '{n}' in hostname:
+            return hostname.replace('{n}', str(number))
+        if len(self.settings['Target']) > 1:
+            return f'{hostname}-{number}'
+        return hostname
 
     def enter_value(self, option):
         while True:
@@ -241,18 +1433,17 @@ class Imager(object):
         return confirmation == 'yes'
 
     def error_quit(self, message):
-        print(message)
+        self.output(message)
         quit(code=-1)
 
+    def output(self, message):
+        with self.print_lock:
+            self.instrumentation.clear_progress()
+            print(message)
+
     def change_settings(self):
         if self.to_change['Target']:
-            self.settings['Target'] = self.select_drive()
-            if self.settings['Target'][-1] in [str(digit) for digit in range(10)]:
-                self.settings['Target boot'] = self.settings['Target'] + 'p1'
-                self.settings['Target root'] = self.settings['Target'] + 'p2'
-            else:
-                self.settings['Target boot'] = self.settings['Target'] + '1'
-                self.settings['Target root'] = self.settings['Target'] + '2'
+            self.settings['Target'] = self.select_drives()
             self.to_change['Target'] = False
         if self.to_change['SSH activation']:
             self.settings['Activate SSH'] = self.confirm(self.input_messages[2])
@@ -292,113 +1483,492 @@ class Imager(object):
         print(self.status_messages[21])
         max_tabs = (max(len(key) for key in self.settings.keys())+7) // 8
         for key, value in self.settings.items():
+            value = ', '.join(value) if isinstance(value, list) else value
             print(key, (max_tabs - (len(key)-7) // 8) * '\t', value)
 
     def execute_sequence(self, commands, message):
-        print(self.status_messages[message])
-        for command in commands:
-            success = self.execute_single(command)
-            if not(success[0]):
-                self.error_quit('\n'.join(success[1]) + '\nError: ' + self.error_messages[message])
-        print(self.confirmation_messages[message])
+        def sequence():
+            self.output(self.status_messages[message])
+            for command in commands:
+                success = self.execute_single(command)
+                if not(success[0]):
+                    self.error_quit('\n'.join(success[1]) + '\nError: ' + self.error_messages[message])
+            self.output(self.confirmation_messages[message])
+        self.instrumented(message, sequence)
+
+    def instrumented(self, message, function):
+        self.instrumentation.measure(self.target_label(), self.status_messages[message], self.step_drives(message), self.progress_total(message), function)
+
+    def target_label(self):
+        return 'all'
+
+    def step_drives(self, message):
+        if message == 13:
+            return [device.split('/')[-1] for device in self.stream_devices]
+        return []
+
+    def progress_total(self, message):
+        if message == 13:
+            image = self.source.get('Golden image', self.settings['Image path'])
+            size = self.call(f'image size {image}', lambda: stat_image(image).st_size) if image != self.settings['Image path'] else self.index['size']
+            return size * len(self.stream_devices)
+        return None
 
     def execute_single(self, command):
-        task = subprocess.Popen(command , shell=True, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-        task.wait()
-        if task.returncode == 0:
-            return [True, [line.decode('utf-8').strip('\n') for line in task.stdout.readlines()]]
-        else:
-            return [False, [line.decode('utf-8').strip('\n') for line in task.stdout.readlines()]]
+        return self.runner.run(self.target_label(), command)
+
+    def call(self, label, function, *arguments, **keywords):
+        return self.runner.call(self.target_label(), label, function, *arguments, **keywords)
+
+    def execute_graph(self, steps):
+        done = set()
+        running = {}
+        with ThreadPoolExecutor(max_workers=len(steps)) as pool:
+            while len(done) < len(steps):
+                for name, (function, dependencies) in steps.items():
+                    ready = all(dependency in done or dependency not in steps for dependency in dependencies)
+                    if ready and name not in done and name not in running.values():
+                        running[pool.submit(function)] = name
+                if not(running):
+                    raise Exception('Workflow steps depend on each other: ' + ', '.join(set(steps) - done))
+                finished = wait(running, return_when=FIRST_COMPLETED)[0]
+                for future in finished:
+                    name = running.pop(future)
+                    if future.exception() is not None:
+                        wait(running)
+                        raise future.exception()
+                    done.add(name)
 
     def exception_handler(self, function, message):
-        print(self.status_messages[message])
-        try:
-            function()
-        except Exception as e:
-            self.error_quit('\n'.join(e.args) + '\nError: ' + self.error_messages[message])
-        print(self.confirmation_messages[message])
+        def handler():
+            self.output(self.status_messages[message])
+            try:
+                function()
+            except TargetError:
+                raise
+            except Exception as e:
+                self.error_quit('\n'.join(str(arg) for arg in e.args) + '\nError: ' + self.error_messages[message])
+            self.output(self.confirmation_messages[message])
+        self.instrumented(message, handler)
 
     def read_file(self, filelocation):
-        with open(filelocation, 'r') as file:
-            content = file.readlines()
-        return content
+        return self.runner.read(self.target_label(), filelocation, read_lines)
 
     def write_file(self, filelocation, content):
-        print(f'File {filelocation} written.')
-        with open(filelocation, 'w') as file:
-            for line in content:
-                file.write(line + '\n')
+        self.output(f'File {filelocation} written.')
+        self.runner.write(self.target_label(), filelocation, content, write_lines)
 
     def perform_cleanup(self):
         commands = []
-        mount_return = self.execute_single('mount')[1]
-        for line in mount_return:
-            if self.settings['Target boot'] in line:
-                commands.insert(0, 'umount ' + line.split(' ')[2])
-            if self.settings['Target root'] in line:
-                commands.append('umount ' + line.split(' ')[2])
-            if 'loop9' in line:
-                commands.append('umount ' + line.split(' ')[2])
-        if path.exists('/tmp/trgt'):
-            commands.append('rm -r /tmp/trgt')
-        if path.exists('/tmp/src'):
-            commands.append('rm -r /tmp/src')
-        commands.append('losetup -D')
+        mount_points = []
+        for source, mount_point, device in self.call('mounts', mounted_filesystems):
+            for directory in self.paths.values():
+                if mount_point == directory or mount_point.startswith(directory + '/'):
+                    mount_points.append(mount_point)
+        for mount_point in sorted(mount_points, key=len, reverse=True):
+            commands.append('umount ' + mount_point)
+        for directory in self.paths.values():
+            if path.exists(directory):
+                commands.append('rm -r ' + directory)
+        for loop in self.attached_loops:
+            commands.append(f'losetup -d /dev/{loop}')
         self.execute_sequence(commands, 0)
+        self.attached_loops = []
 
-    def create_partition_table(self):
-        device = self.settings['Target']
+    def attach_image(self):
+        image = self.settings['Image path']
+        source = self.paths['Source']
+        for part in ['Boot', 'Root']:
+            partition = self.image_partition(part.lower())
+            self.source[part] = f"/dev/{self.attach_partition(image, part.lower())}"
+            self.source[f'{part} size'] = partition['size']
+            self.source[f'{part} used'] = partition['used'] if partition['used'] is not None else partition['size']
+        if self.settings['Copy mode'] == 'block':
+            return
         commands = [
-            f'parted -s /dev/{device} mktable gpt',
-            f'parted -s -a optimal /dev/{device} mkpart {device[:3]}boot fat32 4.096 256M',
-            f'parted -s -a optimal /dev/{device} mkpart {device[:3]}root ext4 256M "100%"',
-            'sleep 1',
+            f'mkdir -p {source}/boot {source}/root',
+            f"mount -o ro {self.source['Boot']} {source}/boot",
+            f"mount -o ro {self.source['Root']} {source}/root",
         ]
-        self.execute_sequence(commands, 1)
+        for command in commands:
+            success = self.execute_single(command)
+            if not(success[0]):
+                raise Exception(*success[1])
 
-    def format_partitions(self):
-        boot = self.settings['Target boot']
-        root = self.settings['Target root']
-        commands = [
-            f'mkfs.vfat -F 32 /dev/{boot}',
-            f'mkfs.ext4 /dev/{root}',
-        ]
-        self.execute_sequence(commands, 2)
+    def image_partition(self, part):
+        for partition in self.index['partitions']:
+            if partition['number'] == self.index[part]:
+                return partition
+        raise Exception(f"The image has no {part} partition with {'a FAT' if part == 'boot' else 'an ext4'} filesystem.")
 
-    def prepare_target(self):
-        boot = self.settings['Target boot']
-        root = self.settings['Target root']
-        commands = [
-            'mkdir /tmp/trgt',
-            f'mount /dev/{root} /tmp/trgt',
-            'mkdir /tmp/trgt/boot',
-            f'mount /dev/{boot} /tmp/trgt/boot',
-        ]
-        self.execute_sequence(commands, 3)
+    def attach_partition(self, image, part, read_only=True):
+        partition = self.image_partition(part)
+        attached = self.execute_single(f"losetup -f --show {'-r ' if read_only else ''}-o {partition['start']} --sizelimit {partition['size']} {image}")
+        if not(attached[0]):
+            raise Exception(*attached[1])
+        loop = attached[1][-1].split('/')[-1]
+        self.attached_loops.append(loop)
+        return loop
+
+    def load_image_index(self):
+        self.index = self.call('image index', self.index_image)
+        for part in ['boot', 'root']:
+            self.image_partition(part)
 
-    def mount_copy_image(self):
+    def index_image(self):
         image = self.settings['Image path']
-        commands = [
-            f'losetup /dev/loop9 -P {image}',
-            'mkdir /tmp/src',
-            'mount /dev/loop9p2 /tmp/src',
-            'rsync -ax /tmp/src/ /tmp/trgt/',
-            'umount /tmp/src/',
-            'mount /dev/loop9p1 /tmp/src',
-            'rsync -ax /tmp/src/ /tmp/trgt/boot/',
-            'umount /tmp/src/',
-            'rm -r /tmp/src/',
-        ]
-        self.execute_sequence(commands, 4)
+        directory = self.settings['Image index']
+        images_file = f'{directory}/images.json'
+        images = {}
+        if path.exists(images_file):
+            with open(images_file, 'r') as file:
+                images = json.load(file)
+        image_stat = stat_image(image)
+        known = images.get(image, {})
+        if known.get('size') == image_stat.st_size and known.get('mtime') == image_stat.st_mtime_ns:
+            self.index = self.read_image_index(f"{directory}/{known['hash']}.json")
+            if self.index is not None:
+                self.output(f"Using image index {directory}/{known['hash']}.json.")
+                return self.index
+        if is_stored(image):
+            digest = load_manifest(image)['sha256']
+        else:
+            hasher = hashlib.sha256()
+            with open(image, 'rb', buffering=0) as file:
+                for data in iter(lambda: file.read(CHUNK_SIZE), b''):
+                    hasher.update(data)
+            digest = hasher.hexdigest()
+        index_file = f'{directory}/{digest}.json'
+        self.index = self.read_image_index(index_file)
+        makedirs(directory, exist_ok=True)
+        if self.index is None or not(self.index['complete'] or is_compressed(image) or is_stored(image)):
+            self.index = inspect_image(image)
+            self.index.update({'version': INDEX_VERSION, 'hash': digest})
+            with open(index_file + '.tmp', 'w') as file:
+                json.dump(self.index, file, indent=1)
+            rename(index_file + '.tmp', index_file)
+        images[image] = {'size': image_stat.st_size, 'mtime': image_stat.st_mtime_ns, 'hash': digest}
+        with open(images_file + '.tmp', 'w') as file:
+            json.dump(images, file)
+        rename(images_file + '.tmp', images_file)
+        return self.index
+
+    def read_image_index(self, index_file):
+        if not(path.exists(index_file)):
+            return None
+        with open(index_file, 'r') as file:
+            index = json.load(file)
+        return index if index.get('version') == INDEX_VERSION else None
+
+    def copy_estimate(self):
+        if self.settings['Copy mode'] == 'stream':
+            return self.index['size']
+        partitions = [self.image_partition('boot'), self.image_partition('root')]
+        return sum(partition['used'] if partition['used'] is not None else partition['size'] for partition in partitions)
+
+    def show_plan(self):
+        index = self.index
+        lines = [f"Image {self.settings['Image path']}: {index['size'] // MiB} MiB, sha256 {index['hash']}"]
+        for partition in index['partitions']:
+            role = {index['boot']: ' (boot)', index['root']: ' (root)'}.get(partition['number'], '')
+            used = f", {partition['used'] // MiB} MiB used" if partition['used'] is not None else ''
+            lines.append(f"Partition {partition['number']}{role}: {partition['start'] // MiB} MiB offset, {partition['size'] // MiB} MiB, {partition['filesystem'] or partition['type']}{used}")
+        if index['hostname'] is not None:
+            lines.append(f"Current hostname: {index['hostname']}")
+        if index['cmdline'] is not None:
+            lines.append(f"Current cmdline.txt: {index['cmdline']}")
+        estimate = self.copy_estimate()
+        for number, drive in enumerate(self.settings['Target'], start=1):
+            worker = TargetImager(self, drive, number)
+            lines.append(f"[{drive}] About {estimate // MiB} MiB of {self.device_size(drive) // MiB} MiB would be written, steps: {', '.join(worker.workflow_steps())}")
+            if estimate > self.device_size(drive):
+                lines.append(f'[{drive}] The drive is smaller than the image.')
+        self.output('\n'.join(lines))
+
+    def device_size(self, device):
+        return int(self.call(f'device size {device}', lambda: read_lines(f'/sys/class/block/{device}/size')[0])) * 512
+
+    def provision_targets(self, workers=None):
+        if workers is None:
+            workers = [TargetImager(self, drive, number) for number, drive in enumerate(self.settings['Target'], start=1)]
+        if not(workers):
+            return {}
+        max_workers = int(self.get_option('workers', len(workers)))
+        results = {}
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            futures = {pool.submit(worker.execute_workflow): worker for worker in workers}
+            for future in as_completed(futures):
+                drive = futures[future].settings['Target']
+                try:
+                    future.result()
+                    results[drive] = None
+                except Exception as e:
+                    results[drive] = '\n'.join(str(arg) for arg in e.args)
+        return results
+
+    def stream_targets(self):
+        workers = [TargetImager(self, drive, number) for number, drive in enumerate(self.settings['Target'], start=1)]
+        results = {}
+        for worker in workers:
+            try:
+                worker.open_journal()
+                worker.perform_cleanup()
+            except TargetError as e:
+                results[worker.settings['Target']] = '\n'.join(e.args)
+        self.stream_devices = {}
+        for worker in workers:
+            if worker.settings['Target'] in results:
+                continue
+            if worker.journal.done('stream'):
+                worker.output(f"{self.status_messages[19]} stream")
+                continue
+            if self.settings['Verify writes'] and not(worker.journal.state('stream', 'written')) and worker.load_delta_index() is None:
+                try:
+                    worker.exception_handler(worker.probe_capacity, 30)
+                except TargetError as e:
+                    results[worker.settings['Target']] = '\n'.join(e.args)
+                    continue
+            self.stream_devices[f"/dev/{worker.settings['Target']}"] = worker
+        self.exception_handler(self.stream_image, 13)
+        if self.settings['Verify writes'] and self.stream_devices:
+            self.exception_handler(self.verify_streams, 33)
+        for device, error in self.stream_errors.items():
+            if error is not None:
+                results[device.split('/')[-1]] = error
+        results.update(self.provision_targets([worker for worker in workers if worker.settings['Target'] not in results]))
+        return results
+
+    def stream_image(self):
+        self.stream_errors = {}
+        if not(self.stream_devices):
+            return
+        offsets = {device: worker.journal.state('stream', 'written', 0) for device, worker in self.stream_devices.items()}
+        checkpoint = lambda device, written: self.stream_devices[device].journal.record('stream', written=written)
+        indexes = {device: worker.load_delta_index() for device, worker in self.stream_devices.items()}
+        self.stream_digests = [] if self.settings['Verify writes'] else None
+        self.stream_blocks = [] if self.settings['Delta index'] != 'not set' else None
+        errors, streamed, written = self.call('stream image', self.stream_to_devices, offsets, checkpoint, indexes)
+        self.stream_errors = {device: error if error is None else error + '\nError: ' + self.error_messages[13] for device, error in errors.items()}
+        if all(error is not None for error in self.stream_errors.values()):
+            return
+        for device, error in self.stream_errors.items():
+            if error is None:
+                self.stream_devices[device].journal.record('stream', written=streamed, finished=time())
+                self.stream_devices[device].stream_blocks = self.stream_blocks
+                if indexes[device] is not None:
+                    self.stream_devices[device].output(f'{written[device] // MiB} MiB of {streamed // MiB} MiB differed and were written.')
+        self.output(f'{streamed // MiB} MiB streamed to each target.')
+
+    def stream_to_devices(self, offsets, checkpoint, indexes):
+        stream, process = open_image_stream(self.source.get('Golden image', self.settings['Image path']))
+        with stream:
+            errors, streamed, written = stream_to_targets(stream, list(self.stream_devices), offsets, checkpoint, self.stream_digests, indexes, self.stream_blocks, max_inflight=self.max_inflight)
+        if process is not None and not(all(error is not None for error in errors.values())) and process.wait() != 0:
+            raise Exception(*process.stderr.read().decode().strip('\n').split('\n'))
+        return errors, streamed, written
+
+    def verify_streams(self):
+        devices = [device for device, error in self.stream_errors.items() if error is None]
+        if not(devices):
+            return
+        with ThreadPoolExecutor(max_workers=len(devices)) as pool:
+            for device, bad_offset in zip(devices, pool.map(lambda device: self.call(f'verify {device}', verify_digests, device, self.stream_digests), devices)):
+                if bad_offset is not None:
+                    self.stream_errors[device] = f'First bad block at offset {bad_offset} of {device}.\nError: ' + self.error_messages[33]
+
+    def prepare_golden_image(self):
+        cache = self.settings['Image cache']
+        self.call(f'create {cache}', makedirs, cache, exist_ok=True)
+        settings = {key: self.settings[key] for key in ['Activate SSH', 'Activate wifi', 'Wifi country', 'Wifi SSID']}
+        settings['Wifi password'] = self.hidden_settings['Wifi password']
+        settings['Cache version'] = CACHE_VERSION
+        key = hashlib.sha256((self.image_hash() + json.dumps(settings, sort_keys=True)).encode()).hexdigest()
+        golden = f'{cache}/{key}.img'
+        lock = self.call(f'lock {cache}', lock_directory, cache)
+        try:
+            if self.call(f'cached image {golden}', path.exists, golden):
+                self.output(f'Using cached image {golden}.')
+                self.call(f'touch {golden}', utime, golden)
+            else:
+                self.build_golden_image(golden)
+            self.source['Golden image'] = golden
+            self.call(f'evict {cache}', evict_cache, cache, self.cache_size, golden)
+        finally:
+            self.call(f'unlock {cache}', os_close, lock)
+
+    def execute_daemon(self):
+        self.exception_handler(self.load_image_index, 36)
+        if self.settings['Image cache'] != 'not set':
+            self.perform_cleanup()
+            self.exception_handler(self.prepare_golden_image, 14)
+            self.perform_cleanup()
+        workers = int(self.get_option('workers', 1))
+        self.slots = [None] * workers
+        self.free_slots = Queue()
+        for slot in range(workers):
+            self.free_slots.put(slot)
+        self.active = set()
+        jobs = 0
+        self.output(f'Waiting for drives, {workers} jobs run in parallel.')
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            for action, drive in hotplug_events(set(block_devices())):
+                if action != 'add' or drive in self.active:
+                    continue
+                sleep(HOTPLUG_SETTLE)
+                block_device_info.cache_clear()
+                device_geometry.cache_clear()
+                if not(self.hotplug_candidate(drive)):
+                    self.output(f'{drive} attached, it does not match any rule.')
+                    continue
+                jobs += 1
+                self.active.add(drive)
+                self.output(f'{drive} attached, queued as job {jobs}.')
+                pool.submit(self.run_job, drive, jobs)
+
+    def hotplug_candidate(self, drive):
+        if not(target_drive(drive)):
+            return False
+        info = dict(block_device_info(drive))
+        info['vendor'] = read_sysfs(f'/sys/block/{drive}/device/vendor')
+        return bool(info['size']) and any(drive_matches(info, rule) for rule in self.rules)
+
+    def run_job(self, drive, number):
+        slot = self.free_slots.get()
+        started = time()
+        success = False
+        try:
+            self.slots[slot] = f'{drive}: job {number} started'
+            self.show_slots()
+            success = self.provision_hotplugged(slot, drive, number)
+            self.output(f"[slot {slot + 1}] {drive}: {'provisioned successfully' if success else 'provisioning failed'}.")
+        except Exception as e:
+            self.output(f'[slot {slot + 1}] {drive}: ' + '\n'.join(str(arg) for arg in e.args))
+        finally:
+            labels = {'result': 'success' if success else 'failure'}
+            self.instrumentation.add_sample('job_duration_seconds', labels, time() - started)
+            self.instrumentation.add_sample('jobs', labels, 1)
+            self.instrumentation.emit('job', target=drive, number=number, success=success, seconds=round(time() - started, 3))
+            self.instrumentation.write_prometheus()
+            self.slots[slot] = None
+            self.active.discard(drive)
+            self.free_slots.put(slot)
+            self.show_slots()
+
+    def show_slots(self):
+        self.output('\n'.join(f"[slot {slot + 1}] {status or 'idle'}" for slot, status in enumerate(self.slots)))
+
+    def provision_hotplugged(self, slot, drive, number):
+        settings = {key: self.settings[key] for key in ['Activate SSH', 'Activate wifi', 'Modify hostname']}
+        settings['Target'] = [drive]
+        if self.settings['Activate wifi']:
+            settings.update({key: self.settings[key] for key in ['Wifi country', 'Wifi SSID']})
+            settings['Wifi password'] = self.hidden_settings['Wifi password']
+        if self.settings['Modify hostname']:
+            hostname = self.settings['Hostname entered']
+            settings['Hostname entered'] = hostname.replace('{n}', str(number)) if '{n}' in hostname else f'{hostname}-{number}'
+        descriptor, settings_file = tempfile.mkstemp(suffix='.json')
+        work = tempfile.mkdtemp(prefix=f'raspi-img2headless-{drive}-')
+        try:
+            with open(descriptor, 'w') as file:
+                json.dump(settings, file)
+            arguments = []
+            for argument in argv[1:]:
+                option, separator, value = argument.partition('=')
+                if option in ['--daemon', '--workers', '--settings', '--work', '--prometheus']:
+                    continue
+                if option in ['--events', '--record'] and value:
+                    root, extension = path.splitext(value)
+                    argument = f'{option}={root}-{drive}-{number}{extension}'
+                arguments.append(argument)
+            command = [executable, path.abspath(argv[0])] + arguments + [f'--settings={settings_file}', f'--work={work}', '--no-progress']
+            task = subprocess.Popen(command, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+            forwarding = False
+            for line in task.stdout:
+                line = line.decode(errors='replace').rstrip('\n')
+                forwarding = forwarding or line == self.status_messages[36]
+                if forwarding or line.startswith('Error'):
+                    self.slots[slot] = f'{drive}: {line}'
+                    self.output(f'[slot {slot + 1}] {line}')
+            return task.wait() == 0
+        finally:
+            remove(settings_file)
+            try:
+                rmdir(work)
+            except OSError:
+                pass
+
+    def import_to_store(self):
+        image = self.settings['Image path']
+        name = path.basename(image)
+        for extension in COMPRESSED_TYPES + ['.img']:
+            name = name[:-len(extension)] if name.endswith(extension) else name
+        name = self.get_option('name', name)
+        manifest, new = self.call(f'import {image}', store_image, image, self.store_directory(), name)
+        stored = sum(length for digest, length in manifest['chunks'] if digest is not None)
+        self.output(f"{manifest['size'] // MiB} MiB stored as {STORE_PREFIX}{name}: {stored // MiB} MiB of data in {len(manifest['chunks'])} chunks, {new // MiB} MiB of it in new chunks.")
+
+    def image_hash(self):
+        return self.index['hash']
+
+    def build_golden_image(self, golden):
+        building = golden + '.tmp'
+        self.output(f'Building cached image {golden}.')
+        try:
+            self.call(f'write {building}', self.write_image_file, building)
+            self.customize_golden_image(building)
+        except BaseException:
+            if self.call(f'cached image {building}', path.exists, building):
+                self.call(f'remove {building}', remove, building)
+            raise
+        self.call(f'rename {building}', rename, building, golden)
+
+    def customize_golden_image(self, building):
+        loops = []
+        try:
+            for part in ['boot', 'root']:
+                loops.append(self.attach_partition(building, part, False))
+            builder = TargetImager(self, loops[0], 0)
+            builder.settings['Target boot'], builder.settings['Target root'] = loops
+            builder.settings['Modify hostname'] = False
+            builder.customize()
+        except TargetError as e:
+            raise Exception(*e.args)
+        finally:
+            for loop in loops:
+                detached = self.execute_single(f'losetup -d /dev/{loop}')
+                if not(detached[0]):
+                    raise Exception(*detached[1])
+                self.attached_loops.remove(loop)
+
+    def write_image_file(self, building):
+        stream, process = open_image_stream(self.settings['Image path'])
+        with stream:
+            stream_to_file(stream, building, max_inflight=self.max_inflight)
+        if process is not None and process.wait() != 0:
+            raise Exception(*process.stderr.read().decode().strip('\n').split('\n'))
+
+    def report_results(self, results):
+        self.output(self.status_messages[22])
+        failed = []
+        for drive in self.settings['Target']:
+            if results[drive] is None:
+                self.output(f'{drive}\t{self.confirmation_messages[22]}')
+            else:
+                self.output(f'{drive}\t{results[drive]}')
+                failed.append(drive)
+        if failed:
+            self.error_quit('Error: ' + self.error_messages[23] + ', '.join(failed))
 
     def activate_ssh(self):
-        self.write_file('/tmp/trgt/boot/ssh', [''])
+        self.write_file(f"{self.paths['Target']}/boot/ssh", [''])
+
+    def derive_psk(self):
+        self.psk = wpa_psk(self.settings['Wifi SSID'], self.hidden_settings['Wifi password'])
 
     def activate_wifi(self):
         country = self.settings['Wifi country']
         ssid = self.settings['Wifi SSID']
-        tmp_psk = self.hidden_settings['Wifi password']
-        psk = self.execute_single(f'wpa_passphrase {ssid} {tmp_psk}')[1][-2].split('psk=')[-1]
+        psk = self.psk
         content = [
             'ctrl_interface=DIR=/var/run/wpa_supplicant GROUP=netdev',
             'update_config=1',
@@ -410,45 +1980,1575 @@ class Imager(object):
             f'\tpsk={psk}',
             '}'
         ]
-        self.write_file('/tmp/trgt/boot/wpa_supplicant.conf', content)
+        self.write_file(f"{self.paths['Target']}/boot/wpa_supplicant.conf", content)
 
     def modify_hostname(self):
-        old_hostname = self.read_file('/tmp/trgt/etc/hostname')[0].strip('\n')
+        target = self.paths['Target']
+        old_hostname = self.read_file(f'{target}/etc/hostname')[0].strip('\n')
         new_hostname = self.settings['Hostname entered']
         file_list = ['hosts', 'hostname']
         for file in file_list:
-            content = self.read_file(f'/tmp/trgt/etc/{file}')
+            content = self.read_file(f'{target}/etc/{file}')
             for linepos, line in enumerate(content):
                 line = line.strip('\n')
                 content[linepos] = line.replace(old_hostname, new_hostname)
-            self.write_file(f'/tmp/trgt/etc/{file}', content)
+            self.write_file(f'{target}/etc/{file}', content)
 
-    def set_root(self):
+    def partition_reference(self, part):
         device = self.settings['Target']
-        content = self.read_file('/tmp/trgt/boot/cmdline.txt')
+        if self.settings['Copy mode'] == 'stream':
+            return f"PARTUUID={self.image_partition(part)['partuuid']}"
+        return f'PARTLABEL={device[:3]}{part}'
+
+    def set_root(self):
+        content = self.read_file(f"{self.paths['Target']}/boot/cmdline.txt")
         for linepos, line in enumerate(content):
 
             parameters = line.split(' ')
             for parameterpos, parameter in enumerate(parameters):
                 if 'root=' in parameter:
-                    parameters[parameterpos] = f'root=PARTLABEL={device[:3]}root'
+                    parameters[parameterpos] = f"root={self.partition_reference('root')}"
                 elif 'init=' in parameter:
                     parameters[parameterpos] = ''
             content[linepos] = ' '.join(parameters)
-        self.write_file('/tmp/trgt/boot/cmdline.txt', content)
+        self.write_file(f"{self.paths['Target']}/boot/cmdline.txt", content)
 
     def modify_fstab(self):
-        device = self.settings['Target']
-        content = self.read_file('/tmp/trgt/etc/fstab')
+        content = self.read_file(f"{self.paths['Target']}/etc/fstab")
         for linepos, line in enumerate(content):
             line = line.strip('\n')
             parameters = line.split(' ')
             if ' / ' in line:
-                parameters[0] = f'PARTLABEL={device[:3]}root'
+                parameters[0] = self.partition_reference('root')
             elif '/boot' in line:
-                parameters[0] = f'PARTLABEL={device[:3]}boot'
+                parameters[0] = self.partition_reference('boot')
             content[linepos] = ' '.join(parameters)
-        self.write_file('/tmp/trgt/etc/fstab', content)
+        self.write_file(f"{self.paths['Target']}/etc/fstab", content)
+
+class TargetImager(Imager):
+    def __init__(self, parent, drive, number):
+        self.print_lock = parent.print_lock
+        self.instrumentation = parent.instrumentation
+        self.input_messages = parent.input_messages
+        self.status_messages = parent.status_messages
+        self.error_messages = parent.error_messages
+        self.confirmation_messages = parent.confirmation_messages
+        self.hidden_settings = parent.hidden_settings
+        self.max_inflight = parent.max_inflight
+        self.runner = parent.runner
+        self.source = parent.source
+        self.index = parent.index
+        self.settings = dict(parent.settings)
+        self.settings['Target'] = drive
+        self.settings['Target boot'], self.settings['Target root'] = self.partition_names(drive, self.partition_numbers())
+        if self.settings['Modify hostname']:
+            self.settings['Hostname entered'] = parent.target_hostname(number)
+        self.paths = {
+            'Source': parent.paths['Source'],
+            'Target': f"{parent.paths['Target']}/{drive}",
+        }
+        self.journal = None
+        self.digests = {}
+        self.volumes = {}
+        self.volume_lock = Lock()
+        self.stream_blocks = None
+        self.delta_changes = []
+
+    def partition_numbers(self):
+        if self.settings['Copy mode'] == 'stream':
+            return self.index['boot'], self.index['root']
+        return 1, 2
+
+    def execute_workflow(self):
+        self.open_journal()
+        steps = self.workflow_steps()
+        self.execute_graph({name: (self.journaled(name, function), dependencies) for name, (function, dependencies) in steps.items()})
+        self.journal.clear()
+
+    def drive_identity(self):
+        drive = self.settings['Target']
+        return self.call(f'drive info {drive}', block_device_info, drive)['serial'] or drive
+
+    def open_journal(self):
+        if self.journal is not None:
+            return
+        identity = self.drive_identity()
+        image_stat = self.call('image stamp', lambda: [stat_image(self.settings['Image path']).st_size, stat_image(self.settings['Image path']).st_mtime_ns])
+        state = {key: value for key, value in self.settings.items() if key not in ['Target', 'Target boot', 'Target root']}
+        state['Wifi password'] = self.hidden_settings['Wifi password']
+        state['Image'] = image_stat
+        key = hashlib.sha256(json.dumps(state, sort_keys=True, default=str).encode()).hexdigest()[:16]
+        directory = self.runner.path(self.get_option('journal', '/var/lib/raspi-img2headless/journal'))
+        self.journal = Journal(f'{directory}/{identity}-{key}.json')
+        info = self.call(f"drive info {self.settings['Target']}", block_device_info, self.settings['Target'])
+        fingerprint = [info['size'], info['model'], info['serial']]
+        recorded = [entry['partuuids'] for entry in self.journal.entries.values() if 'partuuids' in entry]
+        if self.get_option('restart') or self.journal.state('drive', 'fingerprint', fingerprint) != fingerprint or any(partuuids != self.read_partuuids() for partuuids in recorded):
+            self.journal.clear()
+        self.journal.record('drive', fingerprint=fingerprint)
+
+    def journaled(self, name, function):
+        def step():
+            if name in RESUMABLE_STEPS and self.journal.done(name):
+                self.output(f'{self.status_messages[19]} {name}')
+                self.delta_changes = None
+                return
+            function()
+            if name in ['partition', 'grow root']:
+                self.journal.record(name, partuuids=self.read_partuuids())
+            if name in RESUMABLE_STEPS:
+                self.journal.record(name, finished=time())
+        return step
+
+    def delta_index_file(self):
+        return f"{self.settings['Delta index']}/{self.drive_identity()}.json"
+
+    def load_delta_index(self):
+        return self.call('load delta index', self.read_delta_index)
+
+    def read_delta_index(self):
+        if self.settings['Delta index'] == 'not set' or not(path.exists(self.delta_index_file())):
+            return None
+        with open(self.delta_index_file(), 'r') as file:
+            index = json.load(file)
+        if index.get('block size') != DELTA_BLOCK:
+            return None
+        if index.get('stamp') != drive_stamp(f"/dev/{self.settings['Target']}"):
+            return 'read'
+        return index['hashes']
+
+    def save_delta_index(self):
+        self.call('save delta index', self.write_delta_index)
+
+    def write_delta_index(self):
+        device = f"/dev/{self.settings['Target']}"
+        size = self.journal.state('stream', 'written')
+        if self.stream_blocks is None or self.delta_changes is None or not(self.mount_free()):
+            hashes = hash_device(device, size)
+        else:
+            root = Ext4Volume(f"/dev/{self.settings['Target root']}", flags=O_RDONLY)
+            try:
+                start = self.image_partition('root')['start']
+                changed = [(start + offset, length) for offset, length in root.metadata_ranges()]
+            finally:
+                root.close()
+            hashes = rehash_blocks(device, size, self.stream_blocks, [(0, MiB)] + changed + self.delta_changes)
+        index = {
+            'block size': DELTA_BLOCK,
+            'hashes': hashes,
+            'stamp': drive_stamp(device),
+        }
+        makedirs(self.settings['Delta index'], exist_ok=True)
+        with open(self.delta_index_file() + '.tmp', 'w') as file:
+            json.dump(index, file)
+        rename(self.delta_index_file() + '.tmp', self.delta_index_file())
+
+    def read_partuuids(self):
+        partuuids = {}
+        for part in ['boot', 'root']:
+            partition = self.settings[f'Target {part}']
+            success = self.execute_single(f'blkid -s PARTUUID -o value /dev/{partition}')
+            partuuids[part] = success[1][-1] if success[0] and success[1] else None
+        return partuuids
+
+    def workflow_steps(self):
+        steps = {'cleanup': (self.perform_cleanup, [])}
+        if self.settings['Copy mode'] == 'stream':
+            steps['grow root'] = (self.grow_root, ['cleanup'])
+            if self.mount_free():
+                boot_ready = root_ready = ['grow root']
+            else:
+                steps['prepare'] = (self.prepare_target, ['grow root'])
+                boot_ready = root_ready = ['prepare']
+        elif self.settings['Copy mode'] == 'block':
+            if self.settings['Verify writes']:
+                steps['probe'] = (partial(self.exception_handler, self.probe_capacity, 30), ['cleanup'])
+                steps['verify boot'] = (partial(self.exception_handler, self.verify_boot_blocks, 31), ['copy boot'])
+                steps['verify root'] = (partial(self.exception_handler, self.verify_root_blocks, 32), ['copy root'])
+            steps['discard'] = (partial(self.exception_handler, self.discard_target, 35), ['cleanup', 'probe'])
+            steps['partition'] = (self.create_partition_table, ['discard'])
+            steps['copy boot'] = (partial(self.exception_handler, self.copy_boot_blocks, 17), ['partition'])
+            steps['copy root'] = (partial(self.exception_handler, self.copy_root_blocks, 11), ['partition'])
+            steps['grow root'] = (self.grow_root, ['copy root', 'verify root'])
+            if self.mount_free():
+                boot_ready = ['copy boot', 'verify boot']
+                root_ready = ['grow root']
+            else:
+                steps['prepare'] = (self.prepare_target, ['copy boot', 'verify boot', 'grow root'])
+                boot_ready = root_ready = ['prepare']
+        else:
+            if self.settings['Verify writes']:
+                steps['probe'] = (partial(self.exception_handler, self.probe_capacity, 30), ['cleanup'])
+                steps['verify boot'] = (partial(self.exception_handler, self.verify_boot_tree, 31), ['copy boot'])
+                steps['verify root'] = (partial(self.exception_handler, self.verify_root_tree, 32), ['copy root'])
+            steps['discard'] = (partial(self.exception_handler, self.discard_target, 35), ['cleanup', 'probe'])
+            steps['partition'] = (self.create_partition_table, ['discard'])
+            steps['format boot'] = (self.format_boot, ['partition'])
+            steps['format root'] = (self.format_root, ['partition'])
+            steps['prepare'] = (self.prepare_target, ['format boot', 'format root'])
+            steps['copy boot'] = (self.copy_boot, ['prepare'])
+            steps['copy root'] = (self.copy_root, ['prepare'])
+            boot_ready = ['copy boot', 'verify boot']
+            root_ready = ['copy root', 'verify root']
+        steps.update(self.customization_steps(boot_ready, root_ready))
+        steps['final cleanup'] = (self.perform_cleanup, list(steps))
+        if self.settings['Delta index'] != 'not set':
+            steps['delta index'] = (partial(self.exception_handler, self.save_delta_index, 34), ['final cleanup'])
+        return steps
+
+    def customization_steps(self, boot_ready, root_ready):
+        steps = {}
+        if 'Golden image' not in self.source:
+            if self.settings['Activate SSH']:
+                steps['ssh'] = (partial(self.exception_handler, self.activate_ssh, 5), boot_ready)
+            if self.settings['Activate wifi']:
+                steps['derive psk'] = (partial(self.exception_handler, self.derive_psk, 18), [])
+                steps['wifi'] = (partial(self.exception_handler, self.activate_wifi, 6), boot_ready + ['derive psk'])
+            steps['cmdline'] = (partial(self.exception_handler, self.set_root, 7), boot_ready)
+            steps['fstab'] = (partial(self.exception_handler, self.modify_fstab, 8), root_ready)
+        if self.settings['Modify hostname']:
+            steps['hostname'] = (partial(self.exception_handler, self.modify_hostname, 9), root_ready)
+        return steps
+
+    def customize(self):
+        if self.mount_free():
+            steps = self.customization_steps([], [])
+        else:
+            steps = {'prepare': (self.prepare_target, [])}
+            steps.update(self.customization_steps(['prepare'], ['prepare']))
+        steps['cleanup'] = (self.perform_cleanup, list(steps))
+        self.execute_graph(steps)
+
+    def error_quit(self, message):
+        raise TargetError(message)
+
+    def mount_free(self):
+        return self.settings['Copy mode'] in ['block', 'stream'] and not(self.settings['Mount targets'])
+
+    def target_volume(self, filelocation):
+        relative = path.relpath(filelocation, self.paths['Target'])
+        part = 'boot' if relative.split('/')[0] == 'boot' else 'root'
+        with self.volume_lock:
+            if part not in self.volumes:
+                device = f"/dev/{self.settings[f'Target {part}']}"
+                self.volumes[part] = FatVolume(device) if part == 'boot' else Ext4Volume(device)
+        return self.volumes[part], relative[len('boot/'):] if part == 'boot' else relative
+
+    def read_file(self, filelocation):
+        if not(self.mount_free()):
+            return super().read_file(filelocation)
+        return self.runner.read(self.target_label(), filelocation, self.read_volume_file)
+
+    def write_file(self, filelocation, content):
+        if not(self.mount_free()):
+            return super().write_file(filelocation, content)
+        self.runner.write(self.target_label(), filelocation, content, self.write_volume_file)
+        self.output(f'File {filelocation} written.')
+
+    def read_volume_file(self, filelocation):
+        volume, location = self.target_volume(filelocation)
+        return volume.read(location).decode().splitlines(keepends=True)
+
+    def write_volume_file(self, filelocation, content):
+        volume, location = self.target_volume(filelocation)
+        volume.write(location, ''.join(line + '\n' for line in content).encode())
+
+    def close_volumes(self):
+        with self.volume_lock:
+            for part, volume in self.volumes.items():
+                volume.close()
+                if self.stream_blocks is not None and self.delta_changes is not None:
+                    start = self.image_partition(part)['start']
+                    self.delta_changes += [(start + offset, length) for offset, length in volume.written]
+            self.volumes = {}
+
+    def target_label(self):
+        return self.settings['Target']
+
+    def step_drives(self, message):
+        return [self.settings['Target']]
+
+    def progress_total(self, message):
+        if message in [4, 11, 16, 17]:
+            return self.source['Root used' if message in [4, 11] else 'Boot used']
+        return None
+
+    def output(self, message):
+        drive = self.settings['Target']
+        super().output('\n'.join(f'[{drive}] {line}' for line in message.split('\n')))
+
+    def perform_cleanup(self):
+        self.close_volumes()
+        commands = []
+        mount_points = []
+        devices = [self.call(f'device number {partition}', device_number, partition) for partition in [self.settings['Target boot'], self.settings['Target root']]]
+        for source, mount_point, device in self.call('mounts', mounted_filesystems):
+            if device in devices:
+                mount_points.append(mount_point)
+        for mount_point in sorted(mount_points, key=len, reverse=True):
+            commands.append('umount ' + mount_point)
+        if path.exists(self.paths['Target']):
+            commands.append('rm -r ' + self.paths['Target'])
+        self.execute_sequence(commands, 0)
+
+    def create_partition_table(self):
+        self.exception_handler(self.write_partition_table, 1)
+
+    def discard_target(self):
+        device = self.settings['Target']
+        if not(self.call(f'geometry {device}', device_geometry, device)['discard']):
+            self.output('The drive does not support discard.')
+            return
+        if self.call(f'discard {device}', discard_device, f'/dev/{device}', self.device_size(device)):
+            self.output(f'{self.device_size(device) // MiB} MiB discarded.')
+
+    def write_partition_table(self):
+        device = self.settings['Target']
+        alignment = self.call(f'geometry {device}', device_geometry, device)['erase block']
+        boot_end = 256000000
+        if self.settings['Copy mode'] == 'block':
+            boot_end = max(boot_end, alignment + self.source['Boot size'])
+        sector_size = self.call(f'sector size {device}', logical_sector_size, device)
+        layout = [
+            (alignment, boot_end, 'fat32', f'{device[:3]}boot'),
+            (boot_end, None, 'ext4', f'{device[:3]}root'),
+        ]
+        partitions = self.call(f'write gpt {device}', write_gpt, f'/dev/{device}', self.device_size(device), layout, sector_size, alignment)
+        self.call(f'reread {device}', reread_partitions, f'/dev/{device}')
+        names = self.partition_names(device)
+        self.call(f'wait for partitions {device}', wait_for_partitions, {name: partition[:2] for name, partition in zip(names, partitions)}, sector_size)
+
+    def format_boot(self):
+        boot = self.settings['Target boot']
+        self.execute_sequence([f'mkfs.vfat -F 32 /dev/{boot}'], 2)
+
+    def format_root(self):
+        root = self.settings['Target root']
+        geometry = self.call(f"geometry {self.settings['Target']}", device_geometry, self.settings['Target'])
+        options = [
+            f"stride={geometry['io size'] // 4096}",
+            f"stripe_width={geometry['erase block'] // 4096}",
+            'lazy_itable_init=1',
+        ]
+        if geometry['discard']:
+            options += ['lazy_journal_init=1', 'nodiscard']
+        self.execute_sequence([f"mkfs.ext4 -E {','.join(options)} /dev/{root}"], 15)
+
+    def prepare_target(self):
+        boot = self.settings['Target boot']
+        root = self.settings['Target root']
+        target = self.paths['Target']
+        commands = [
+            f'mkdir -p {target}',
+            f'mount /dev/{root} {target}',
+            f'mkdir -p {target}/boot',
+            f'mount /dev/{boot} {target}/boot',
+        ]
+        self.execute_sequence(commands, 3)
+
+    def copy_root(self):
+        source = self.paths['Source']
+        target = self.paths['Target']
+        self.copy_files(f'{source}/root', target, 4)
+        self.record_used_bytes('copy root', target)
+
+    def copy_boot(self):
+        source = self.paths['Source']
+        target = self.paths['Target']
+        self.copy_files(f'{source}/boot', f'{target}/boot', 16)
+        self.record_used_bytes('copy boot', f'{target}/boot')
+
+    def copy_files(self, source, target, message):
+        if self.settings['File copier'] == 'rsync':
+            self.execute_sequence([f'rsync -aHAXx {source}/ {target}/'], message)
+        else:
+            self.exception_handler(partial(self.call, f'copy tree {target}', copy_tree, source, target, max_inflight=self.max_inflight), message)
+
+    def record_used_bytes(self, step, directory):
+        if self.journal is not None:
+            self.journal.record(step, bytes=self.call(f'used bytes {directory}', used_bytes, directory))
+
+    def copy_boot_blocks(self):
+        self.copy_partition_blocks('Boot', fat_used_ranges)
+
+    def copy_root_blocks(self):
+        self.copy_partition_blocks('Root', ext4_used_ranges)
+
+    def copy_partition_blocks(self, part, used_ranges):
+        target = self.settings[f'Target {part.lower()}']
+        if self.source[f'{part} size'] > self.device_size(target):
+            raise Exception(f'Partition /dev/{target} is smaller than the {part.lower()} partition of the image.')
+        step = f'copy {part.lower()}'
+        start = self.journal.state(step, 'offset', 0) if self.journal is not None else 0
+        checkpoint = (lambda offset: self.journal.record(step, offset=offset)) if self.journal is not None else None
+        digests = self.digests.setdefault(part, []) if self.settings['Verify writes'] and not(start) else None
+        copied = self.call(f'copy partition {target}', copy_partition, self.source[part], f'/dev/{target}', used_ranges, start, checkpoint, digests, max_inflight=self.max_inflight)
+        if self.journal is not None:
+            self.journal.record(step, bytes=copied)
+        self.output(f'{copied // MiB} MiB of {self.source[f"{part} size"] // MiB} MiB copied.')
+
+    def probe_capacity(self):
+        device = self.settings['Target']
+        bad_offset = self.call(f'probe {device}', probe_capacity, f'/dev/{device}', self.device_size(device))
+        if bad_offset is not None:
+            raise Exception(f'Marker written at offset {bad_offset} could not be read back; the drive is probably smaller than the reported {self.device_size(device) // MiB} MiB.')
+
+    def verify_boot_blocks(self):
+        self.verify_partition_blocks('Boot', fat_used_ranges)
+
+    def verify_root_blocks(self):
+        self.verify_partition_blocks('Root', ext4_used_ranges)
+
+    def verify_partition_blocks(self, part, used_ranges):
+        target = f"/dev/{self.settings[f'Target {part.lower()}']}"
+        digests = self.digests.get(part)
+        if not(digests):
+            digests = self.call(f"hash partition {self.source[part]}", hash_partition, self.source[part], used_ranges)
+        bad_offset = self.call(f'verify {target}', verify_digests, target, digests)
+        if bad_offset is not None:
+            raise Exception(f'First bad block at offset {bad_offset} of {target}.')
+
+    def verify_boot_tree(self):
+        self.verify_tree_copy('boot', 'boot')
+
+    def verify_root_tree(self):
+        self.verify_tree_copy('root', '')
+
+    def verify_tree_copy(self, source, target):
+        difference = self.call(f'verify tree {source}', verify_tree, f"{self.paths['Source']}/{source}", f"{self.paths['Target']}/{target}".rstrip('/'))
+        if difference is not None:
+            raise Exception(f'{difference[0]} differs from the image at offset {difference[1]}.')
+
+    def grow_root(self):
+        self.exception_handler(self.grow_root_partition, 12)
+
+    def grow_root_partition(self):
+        device = self.settings['Target']
+        root = self.settings['Target root']
+        commands = []
+        if self.settings['Copy mode'] == 'stream':
+            self.call(f'reread {device}', reread_partitions, f'/dev/{device}')
+            self.call(f'wait for partitions {device}', wait_for_partitions, {root: None})
+            commands.append(f'parted -s /dev/{device} resizepart {self.partition_numbers()[1]} "100%"')
+        commands += [
+            f'e2fsck -f -p /dev/{root} || test $? -eq 1',
+            f'resize2fs /dev/{root}',
+        ]
+        for command in commands:
+            success = self.execute_single(command)
+            if not(success[0]):
+                raise Exception(*success[1])
+
+def read_sysfs(file, default=''):
+    try:
+        with open(file, 'r') as sysfs_file:
+            return sysfs_file.read().strip()
+    except OSError:
+        return default
+
+def block_devices():
+    return sorted(drive for drive in listdir('/sys/block') if not(drive.startswith('ram')))
+
+@lru_cache(maxsize=None)
+def block_device_info(drive):
+    serial = ''
+    udev_data = read_sysfs(f"/run/udev/data/b{read_sysfs(f'/sys/block/{drive}/dev')}")
+    for line in udev_data.split('\n'):
+        if line.startswith('E:ID_SERIAL_SHORT='):
+            serial = line.split('=', 1)[1]
+    return {
+        'size': int(read_sysfs(f'/sys/block/{drive}/size', '0')) * 512,
+        'model': read_sysfs(f'/sys/block/{drive}/device/model'),
+        'removable': read_sysfs(f'/sys/block/{drive}/removable') == '1',
+        'serial': serial or read_sysfs(f'/sys/block/{drive}/device/serial'),
+    }
+
+def device_number(device):
+    return read_sysfs(f'/sys/class/block/{device}/dev', None)
+
+def unescape_mount_field(field):
+    return field.encode().decode('unicode_escape').encode('latin-1').decode()
+
+def mounted_filesystems():
+    mounts = []
+    with open('/proc/self/mountinfo', 'r') as file:
+        for line in file:
+            fields = line.split(' ')
+            separator = fields.index('-', 6)
+            mounts.append((unescape_mount_field(fields[separator + 2]), unescape_mount_field(fields[4]), fields[2]))
+    return mounts
+
+def drive_partitions(drive):
+    return [drive] + [name for name in listdir(f'/sys/block/{drive}') if name.startswith(drive)]
+
+def drive_holders(drive):
+    pending = [f'/sys/class/block/{name}/holders' for name in drive_partitions(drive)]
+    holders = []
+    while pending:
+        directory = pending.pop()
+        for holder in listdir(directory) if path.isdir(directory) else []:
+            if holder not in holders:
+                holders.append(holder)
+                pending.append(f'/sys/class/block/{holder}/holders')
+    return holders
+
+def drive_mount_points(drive):
+    devices = [device_number(name) for name in drive_partitions(drive) + drive_holders(drive)]
+    mount_points = [mount_point for source, mount_point, device in mounted_filesystems() if device in devices]
+    for line in read_sysfs('/proc/swaps').split('\n')[1:]:
+        if line and device_number(path.basename(path.realpath(line.split()[0]))) in devices:
+            mount_points.append('[swap]')
+    return mount_points
+
+def target_drive(drive):
+    return path.exists(f'/sys/block/{drive}/device') and not(drive_holders(drive) or drive_mount_points(drive))
+
+def drive_matches(info, rule):
+    if info['size'] < rule.get('Minimum size', 0) or info['size'] > rule.get('Maximum size', info['size']):
+        return False
+    if 'Removable' in rule and info['removable'] != bool(rule['Removable']):
+        return False
+    return all(fnmatch(info[key.lower()].lower(), str(rule[key]).lower()) for key in ['Vendor', 'Model', 'Serial'] if key in rule)
+
+def hotplug_events(present):
+    try:
+        listener = socket.socket(socket.AF_NETLINK, socket.SOCK_DGRAM, NETLINK_KOBJECT_UEVENT)
+        listener.bind((0, 1))
+    except OSError:
+        listener = None
+    while True:
+        if listener is not None:
+            message = listener.recv(65536).decode(errors='replace').split('\0')
+            fields = dict(field.split('=', 1) for field in message[1:] if '=' in field)
+            if fields.get('SUBSYSTEM') != 'block' or fields.get('DEVTYPE') != 'disk':
+                continue
+            events = [(fields.get('ACTION'), fields.get('DEVNAME', '').split('/')[-1])]
+        else:
+            sleep(HOTPLUG_POLL)
+            current = set(block_devices())
+            events = [('add', drive) for drive in sorted(current - present)] + [('remove', drive) for drive in sorted(present - current)]
+        for action, drive in events:
+            if action == 'add':
+                present.add(drive)
+            elif action == 'remove':
+                present.discard(drive)
+            else:
+                continue
+            yield action, drive
+
+@lru_cache(maxsize=None)
+def wpa_psk(ssid, passphrase):
+    if not(8 <= len(passphrase) <= 63):
+        raise Exception('The wifi password must be 8 to 63 characters long.')
+    return hashlib.pbkdf2_hmac('sha1', passphrase.encode(), ssid.encode(), 4096, 32).hex()
+
+@lru_cache(maxsize=None)
+def device_geometry(drive):
+    queue = {}
+    for name in ['discard_granularity', 'discard_max_bytes', 'minimum_io_size', 'optimal_io_size']:
+        queue[name] = int(read_sysfs(f'/sys/block/{drive}/queue/{name}', '0') or '0')
+    erase_block = max(PARTITION_ALIGNMENT, queue['optimal_io_size'], queue['discard_granularity'])
+    return {
+        'discard': queue['discard_max_bytes'] > 0,
+        'io size': max(queue['minimum_io_size'], 4096),
+        'erase block': -(-erase_block // PARTITION_ALIGNMENT) * PARTITION_ALIGNMENT,
+    }
+
+def discard_device(target, size):
+    fd = os_open(target, O_WRONLY)
+    try:
+        ioctl(fd, BLKDISCARD, struct.pack('QQ', 0, size))
+    except OSError as e:
+        if e.errno in [EOPNOTSUPP, EINVAL]:
+            return False
+        raise
+    finally:
+        os_close(fd)
+    return True
+
+def logical_sector_size(device):
+    return int(read_sysfs(f'/sys/class/block/{device}/queue/logical_block_size', '512'))
+
+def gpt_header(sector_size, sectors, current, backup, first_usable, last_usable, disk_guid, entries_lba, entries):
+    header = struct.pack('<8sIIIIQQQQ16sQIII', b'EFI PART', 0x10000, 92, 0, 0, current, backup, first_usable, last_usable, disk_guid, entries_lba, GPT_ENTRIES, 128, zlib.crc32(entries))
+    header = header[:16] + struct.pack('<I', zlib.crc32(header)) + header[20:]
+    return header + bytes(sector_size - len(header))
+
+def build_gpt(size, layout, sector_size=512, alignment=PARTITION_ALIGNMENT):
+    sectors = size // sector_size
+    entry_sectors = GPT_ENTRIES * 128 // sector_size
+    first_usable = 2 + entry_sectors
+    last_usable = sectors - entry_sectors - 2
+    align = alignment // sector_size
+    partitions = []
+    entries = b''
+    for start, end, kind, name in layout:
+        first = -(-start // sector_size // align) * align
+        last = last_usable if end is None else -(-end // sector_size // align) * align - 1
+        if first < first_usable or last > last_usable or last < first:
+            raise Exception(f'Partition {name} does not fit on a device of {size // MiB} MiB.')
+        partitions.append((first, last - first + 1, name))
+        entries += struct.pack('<16s16sQQQ72s', uuid.UUID(GPT_TYPES[kind]).bytes_le, uuid.uuid4().bytes_le, first, last, 0, name.encode('utf-16-le')[:72])
+    entries += bytes(GPT_ENTRIES * 128 - len(entries))
+    mbr = bytearray(sector_size)
+    mbr[446:462] = struct.pack('<B3sB3sII', 0, b'\x00\x02\x00', 0xEE, b'\xff\xff\xff', 1, min(sectors - 1, 0xFFFFFFFF))
+    mbr[510:512] = b'\x55\xaa'
+    disk_guid = uuid.uuid4().bytes_le
+    primary = bytes(mbr) + gpt_header(sector_size, sectors, 1, sectors - 1, first_usable, last_usable, disk_guid, 2, entries) + entries
+    backup = entries + gpt_header(sector_size, sectors, sectors - 1, 1, first_usable, last_usable, disk_guid, sectors - 1 - entry_sectors, entries)
+    return primary, backup, partitions
+
+def write_gpt(target, size, layout, sector_size=512, alignment=PARTITION_ALIGNMENT):
+    primary, backup, partitions = build_gpt(size, layout, sector_size, alignment)
+    fd = os_open(target, O_WRONLY)
+    try:
+        pwrite_all(fd, primary, 0)
+        pwrite_all(fd, backup, (size // sector_size) * sector_size - len(backup))
+        fsync(fd)
+    finally:
+        os_close(fd)
+    return partitions
+
+def reread_partitions(target):
+    if not(S_ISBLK(stat(target).st_mode)):
+        return
+    fd = os_open(target, O_RDONLY)
+    try:
+        for attempt in range(10):
+            try:
+                ioctl(fd, BLKRRPART)
+                return
+            except OSError as e:
+                if e.errno != EBUSY or attempt == 9:
+                    raise Exception(f'{target}: the kernel could not re-read the partition table ({e.strerror}).')
+                sleep(0.2)
+    finally:
+        os_close(fd)
+
+def wait_for_partitions(partitions, sector_size=512, timeout=PARTITION_TIMEOUT):
+    deadline = time() + timeout
+    waiting = dict(partitions)
+    while waiting:
+        for name, geometry in list(waiting.items()):
+            try:
+                if not(S_ISBLK(stat(f'/dev/{name}').st_mode)):
+                    continue
+                if geometry is not None:
+                    with open(f'/sys/class/block/{name}/start', 'r') as file:
+                        start = int(file.read()) * 512
+                    with open(f'/sys/class/block/{name}/size', 'r') as file:
+                        length = int(file.read()) * 512
+                    if (start, length) != (geometry[0] * sector_size, geometry[1] * sector_size):
+                        continue
+                del waiting[name]
+            except (OSError, ValueError):
+                continue
+        if waiting and time() > deadline:
+            raise Exception(f"Partition {', '.join(f'/dev/{name}' for name in waiting)} did not appear within {timeout} seconds.")
+        if waiting:
+            sleep(0.02)
+
+def merge_ranges(ranges, gap=64 * 1024):
+    merged = []
+    for offset, length in sorted(ranges):
+        if merged and offset <= merged[-1][0] + merged[-1][1] + gap:
+            merged[-1][1] = max(merged[-1][1], offset + length - merged[-1][0])
+        else:
+            merged.append([offset, length])
+    return [(offset, length) for offset, length in merged]
+
+def bitmap_ranges(bitmap, bits, first, unit):
+    ranges = []
+    start = None
+    for index, byte in enumerate(bytes(bitmap[:-(-bits // 8)])):
+        pos = index * 8
+        if byte == 255 and pos + 8 <= bits:
+            if start is None:
+                start = pos
+        elif byte == 0:
+            if start is not None:
+                ranges.append(((first + start) * unit, (pos - start) * unit))
+                start = None
+        else:
+            for bit in range(min(8, bits - pos)):
+                if (byte >> bit) & 1:
+                    if start is None:
+                        start = pos + bit
+                elif start is not None:
+                    ranges.append(((first + start) * unit, (pos + bit - start) * unit))
+                    start = None
+    if start is not None:
+        ranges.append(((first + start) * unit, (bits - start) * unit))
+    return ranges
+
+def ext4_geometry(superblock):
+    if struct.unpack_from('<H', superblock, 0x38)[0] != 0xEF53:
+        return None
+    blocks_count, = struct.unpack_from('<I', superblock, 0x04)
+    first_data_block, log_block_size = struct.unpack_from('<II', superblock, 0x14)
+    blocks_per_group, = struct.unpack_from('<I', superblock, 0x20)
+    inodes_per_group, = struct.unpack_from('<I', superblock, 0x28)
+    revision, = struct.unpack_from('<I', superblock, 0x4C)
+    compat, incompat, ro_compat = struct.unpack_from('<III', superblock, 0x5C)
+    block_size = 1024 << log_block_size
+    desc_size = 32
+    if incompat & 0x80:
+        blocks_count += struct.unpack_from('<I', superblock, 0x150)[0] << 32
+        desc_size = struct.unpack_from('<H', superblock, 0xFE)[0]
+    return {
+        'block size': block_size,
+        'blocks': blocks_count,
+        'first data block': first_data_block,
+        'blocks per group': blocks_per_group,
+        'groups': -(-(blocks_count - first_data_block) // blocks_per_group),
+        'inodes per group': inodes_per_group,
+        'inode size': struct.unpack_from('<H', superblock, 0x58)[0] if revision else 128,
+        'descriptor size': desc_size,
+        'descriptors': (first_data_block + 1) * block_size,
+        'reserved descriptor blocks': struct.unpack_from('<H', superblock, 0xCE)[0],
+        'backup groups': struct.unpack_from('<II', superblock, 0x24C),
+        'compat': compat,
+        'incompat': incompat,
+        'ro compat': ro_compat,
+    }
+
+def ext4_descriptor(descriptors, group, desc_size):
+    position = group * desc_size
+    block_bitmap, inode_bitmap, inode_table = struct.unpack_from('<III', descriptors, position)
+    flags, = struct.unpack_from('<H', descriptors, position + 0x12)
+    if desc_size >= 64:
+        high = struct.unpack_from('<III', descriptors, position + 0x20)
+        block_bitmap, inode_bitmap, inode_table = [low + (high << 32) for low, high in zip([block_bitmap, inode_bitmap, inode_table], high)]
+    return {'block bitmap': block_bitmap, 'inode bitmap': inode_bitmap, 'inode table': inode_table, 'flags': flags}
+
+def ext4_used_ranges(fd, size, offset=0):
+    geometry = ext4_geometry(pread(fd, 1024, offset + 1024))
+    if geometry is None or geometry['incompat'] & 0x10:
+        return None
+    block_size, blocks_per_group, first_data_block = geometry['block size'], geometry['blocks per group'], geometry['first data block']
+    desc_size = geometry['descriptor size']
+    descriptors = pread(fd, geometry['groups'] * desc_size, offset + geometry['descriptors'])
+    ranges = []
+    for group in range(geometry['groups']):
+        first = first_data_block + group * blocks_per_group
+        bits = min(blocks_per_group, geometry['blocks'] - first)
+        descriptor = ext4_descriptor(descriptors, group, desc_size)
+        if descriptor['flags'] & 0x2:
+            continue
+        bitmap = pread(fd, block_size, offset + descriptor['block bitmap'] * block_size)
+        ranges += bitmap_ranges(bitmap, bits, first, block_size)
+    return merge_ranges([(0, (first_data_block + 1) * block_size)] + ranges + ext4_metadata_ranges(geometry, descriptors))
+
+def ext4_backup_group(geometry, group):
+    if group == 0:
+        return True
+    if geometry['compat'] & 0x200:
+        return group in geometry['backup groups']
+    if not(geometry['ro compat'] & 0x1) or group == 1:
+        return True
+    for base in [3, 5, 7]:
+        power = base
+        while power < group:
+            power *= base
+        if power == group:
+            return True
+    return False
+
+def ext4_metadata_ranges(geometry, descriptors):
+    block_size = geometry['block size']
+    descriptor_blocks = -(-geometry['groups'] * geometry['descriptor size'] // block_size) + geometry['reserved descriptor blocks']
+    table_size = -(-geometry['inodes per group'] * geometry['inode size'] // block_size) * block_size
+    ranges = []
+    for group in range(geometry['groups']):
+        if ext4_backup_group(geometry, group):
+            first = geometry['first data block'] + group * geometry['blocks per group']
+            ranges.append((first * block_size, (1 + descriptor_blocks) * block_size))
+        descriptor = ext4_descriptor(descriptors, group, geometry['descriptor size'])
+        ranges += [(descriptor['block bitmap'] * block_size, block_size), (descriptor['inode bitmap'] * block_size, block_size), (descriptor['inode table'] * block_size, table_size)]
+    return ranges
+
+def fat_geometry(boot_sector):
+    if boot_sector[510:512] != b'\x55\xaa':
+        return None
+    bytes_per_sector, sectors_per_cluster, reserved, fats, root_entries, total16 = struct.unpack_from('<HBHBHH', boot_sector, 11)
+    fat_size16, = struct.unpack_from('<H', boot_sector, 22)
+    total32, fat_size32 = struct.unpack_from('<II', boot_sector, 32)
+    if not(bytes_per_sector and sectors_per_cluster and fats):
+        return None
+    fat_size = (fat_size16 or fat_size32) * bytes_per_sector
+    root_start = reserved * bytes_per_sector + fats * fat_size
+    root_size = -(-(root_entries * 32) // bytes_per_sector) * bytes_per_sector
+    cluster_size = sectors_per_cluster * bytes_per_sector
+    clusters = ((total16 or total32) * bytes_per_sector - root_start - root_size) // cluster_size
+    fat32 = clusters >= 65525
+    return {
+        'sector size': bytes_per_sector,
+        'cluster size': cluster_size,
+        'clusters': clusters,
+        'fat32': fat32,
+        'fat size': fat_size,
+        'fats': [reserved * bytes_per_sector + number * fat_size for number in range(fats)],
+        'root start': root_start,
+        'root size': root_size,
+        'data start': root_start + root_size,
+        'root cluster': struct.unpack_from('<I', boot_sector, 44)[0] if fat32 else 0,
+        'fsinfo': struct.unpack_from('<H', boot_sector, 48)[0] * bytes_per_sector if fat32 else None,
+    }
+
+def fat_used_ranges(fd, size, offset=0):
+    geometry = fat_geometry(pread(fd, 512, offset))
+    if geometry is None or geometry['clusters'] < 4085:
+        return None
+    clusters = geometry['clusters']
+    fat = pread(fd, geometry['fat size'], offset + geometry['fats'][0])
+    if geometry['fat32']:
+        entries = memoryview(fat[:len(fat) // 4 * 4]).cast('I')
+        mask = 0x0FFFFFFF
+    else:
+        entries = memoryview(fat).cast('H')
+        mask = 0xFFFF
+    used = bytearray(-(-clusters // 8))
+    for cluster in range(min(clusters, len(entries) - 2)):
+        if entries[cluster + 2] & mask:
+            used[cluster >> 3] |= 1 << (cluster & 7)
+    ranges = bitmap_ranges(used, clusters, 0, geometry['cluster size'])
+    data_offset = geometry['data start']
+    return merge_ranges([(0, data_offset)] + [(data_offset + start, length) for start, length in ranges])
+
+def read_partition_table(read, sector_size=512):
+    mbr = read(sector_size, 0)
+    if len(mbr) < 512 or mbr[510:512] != b'\x55\xaa':
+        raise Exception('The image does not contain a partition table.')
+    entries = [struct.unpack_from('<4xB3xII', mbr, 446 + 16 * number) for number in range(4)]
+    if any(kind == 0xEE for kind, first, sectors in entries):
+        return read_gpt_partitions(read, sector_size)
+    signature, = struct.unpack_from('<I', mbr, 440)
+    partitions = []
+    for number, (kind, first, sectors) in enumerate(entries, start=1):
+        if kind in EXTENDED_PARTITIONS:
+            partitions += read_logical_partitions(read, first, sector_size)
+        elif kind and sectors:
+            partitions.append({'number': number, 'start': first * sector_size, 'size': sectors * sector_size, 'type': f'0x{kind:02x}'})
+    for partition in partitions:
+        partition['partuuid'] = f'{signature:08x}-{partition["number"]:02x}'
+    return partitions
+
+def read_logical_partitions(read, extended, sector_size=512):
+    partitions = []
+    current = extended
+    while current and len(partitions) < 128:
+        ebr = read(sector_size, current * sector_size)
+        if len(ebr) < 512 or ebr[510:512] != b'\x55\xaa':
+            break
+        kind, first, sectors = struct.unpack_from('<4xB3xII', ebr, 446)
+        following, = struct.unpack_from('<8xI', ebr, 462)
+        if kind and sectors:
+            partitions.append({'number': len(partitions) + 5, 'start': (current + first) * sector_size, 'size': sectors * sector_size, 'type': f'0x{kind:02x}'})
+        current = extended + following if following else 0
+    return partitions
+
+def read_gpt_partitions(read, sector_size=512):
+    header = read(92, sector_size)
+    if header[:8] != b'EFI PART':
+        raise Exception('The protective MBR of the image is not followed by a GPT header.')
+    entries_lba, count, entry_size = struct.unpack_from('<QII', header, 72)
+    entries = read(count * entry_size, entries_lba * sector_size)
+    partitions = []
+    for number in range(1, count + 1):
+        entry = entries[(number - 1) * entry_size:number * entry_size]
+        if len(entry) < 48 or entry[:16] == bytes(16):
+            continue
+        first, last = struct.unpack_from('<QQ', entry, 32)
+        partitions.append({'number': number, 'start': first * sector_size, 'size': (last - first + 1) * sector_size, 'type': str(uuid.UUID(bytes_le=entry[:16])).upper(), 'partuuid': str(uuid.UUID(bytes_le=entry[16:32]))})
+    return partitions
+
+def filesystem_type(read, offset):
+    superblock = read(1024, offset + 1024)
+    if superblock[0x38:0x3A] == b'\x53\xef':
+        return 'ext4'
+    boot_sector = read(512, offset)
+    if boot_sector[510:512] == b'\x55\xaa' and (boot_sector[0x36:0x39] == b'FAT' or boot_sector[0x52:0x57] == b'FAT32'):
+        return 'vfat'
+    return None
+
+def inspect_image(image):
+    if is_stored(image):
+        reader = StoreReader(image)
+        partitions = read_partition_table(reader.read_at)
+        for partition in partitions:
+            partition['filesystem'] = filesystem_type(reader.read_at, partition['start'])
+            partition['used'] = None
+        index = {'size': reader.manifest['size'], 'partitions': partitions}
+    elif is_compressed(image):
+        stream, process = open_image_stream(image)
+        with stream:
+            header = read_chunk(stream, PARTITION_ALIGNMENT)
+        if process is not None:
+            process.kill()
+            process.wait()
+        partitions = read_partition_table(lambda length, offset: header[offset:offset + length])
+        for partition in partitions:
+            partition['filesystem'] = PARTITION_FILESYSTEMS.get(partition['type'])
+            partition['used'] = None
+        index = {'size': max([partition['start'] + partition['size'] for partition in partitions] + [len(header)]), 'partitions': partitions}
+    else:
+        fd = os_open(image, O_RDONLY)
+        try:
+            read = lambda length, offset: pread(fd, length, offset)
+            partitions = read_partition_table(read)
+            for partition in partitions:
+                partition['filesystem'] = filesystem_type(read, partition['start'])
+                used_ranges = {'ext4': ext4_used_ranges, 'vfat': fat_used_ranges}.get(partition['filesystem'])
+                ranges = used_ranges(fd, partition['size'], partition['start']) if used_ranges is not None else None
+                partition['used'] = sum(length for start, length in ranges) if ranges is not None else None
+        finally:
+            os_close(fd)
+        index = {'size': stat(image).st_size, 'partitions': partitions}
+    index['boot'] = next((partition['number'] for partition in partitions if partition['filesystem'] == 'vfat'), None)
+    index['root'] = next((partition['number'] for partition in partitions if partition['filesystem'] == 'ext4'), None)
+    index['hostname'] = index['cmdline'] = None
+    index['complete'] = not(is_compressed(image) or is_stored(image))
+    if index['complete']:
+        for part, volume_type, location, key in [('boot', FatVolume, 'cmdline.txt', 'cmdline'), ('root', Ext4Volume, 'etc/hostname', 'hostname')]:
+            start = next((partition['start'] for partition in partitions if partition['number'] == index[part]), None)
+            if start is None:
+                continue
+            try:
+                volume = volume_type(image, start, O_RDONLY)
+            except Exception:
+                continue
+            try:
+                index[key] = volume.read(location).decode().strip()
+            except Exception:
+                pass
+            finally:
+                os_close(volume.fd)
+    return index
+
+@lru_cache(maxsize=None)
+def crc32c_table():
+    table = []
+    for byte in range(256):
+        crc = byte
+        for bit in range(8):
+            crc = (crc >> 1) ^ (0x82F63B78 if crc & 1 else 0)
+        table.append(crc)
+    return table
+
+def crc32c(crc, data):
+    table = crc32c_table()
+    for byte in data:
+        crc = table[(crc ^ byte) & 0xFF] ^ (crc >> 8)
+    return crc
+
+def fat_first_cluster(entry):
+    return struct.unpack_from('<H', entry, 20)[0] << 16 | struct.unpack_from('<H', entry, 26)[0]
+
+def fat_name_checksum(short_name):
+    checksum = 0
+    for byte in short_name:
+        checksum = ((checksum & 1) << 7 | checksum >> 1) + byte & 0xFF
+    return checksum
+
+def fat_short_name(entry):
+    base = (b'\xe5' + entry[1:8] if entry[0] == 0x05 else entry[:8]).decode('latin-1').rstrip(' ')
+    extension = entry[8:11].decode('latin-1').rstrip(' ')
+    if entry[12] & 0x08:
+        base = base.lower()
+    if entry[12] & 0x10:
+        extension = extension.lower()
+    return f'{base}.{extension}' if extension else base
+
+def fat_83_name(name, existing):
+    valid = set('ABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789!#$%&\'()-@^_`{}~')
+    base, extension = name.rsplit('.', 1) if '.' in name[1:] else (name, '')
+    fits = lambda part, length: len(part) <= length and all(character in valid for character in part.upper()) and part in [part.upper(), part.lower()]
+    if base and fits(base, 8) and fits(extension, 3):
+        short = (base.upper().ljust(8) + extension.upper().ljust(3)).encode()
+        if short not in existing:
+            return short, name != name.upper()
+    clean = lambda part: ''.join(character if character in valid else '_' for character in part.upper() if character not in ' .')
+    base, extension = clean(base), clean(extension)[:3]
+    for number in range(1, 1000000):
+        tail = f'~{number}'
+        short = (base[:8 - len(tail)] + tail).ljust(8).encode() + extension.ljust(3).encode()
+        if short not in existing:
+            return short, True
+
+def fat_timestamp():
+    now = localtime()
+    return now.tm_hour << 11 | now.tm_min << 5 | now.tm_sec // 2, (now.tm_year - 1980) << 9 | now.tm_mon << 5 | now.tm_mday
+
+def sync_file_range(fd, offset, length, flags):
+    function = getattr(LIBC, 'sync_file_range', None)
+    if function is None:
+        if flags & SYNC_FILE_RANGE_WAIT_AFTER:
+            fdatasync(fd)
+        return
+    if function(fd, ctypes.c_int64(offset), ctypes.c_int64(length), ctypes.c_uint(flags)) != 0:
+        error = ctypes.get_errno()
+        raise OSError(error, strerror(error))
+
+def syncfs(fd):
+    function = getattr(LIBC, 'syncfs', None)
+    if function is None:
+        sync()
+    elif function(fd) != 0:
+        error = ctypes.get_errno()
+        raise OSError(error, strerror(error))
+
+def zero_range(fd, offset, length):
+    try:
+        ioctl(fd, BLKZEROOUT, struct.pack('QQ', offset, length))
+    except OSError:
+        pwrite(fd, bytes(length), offset)
+
+def chunk_digest(data):
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+def copy_partition(source, target, used_ranges, start=0, checkpoint=None, digests=None, chunk_size=CHUNK_SIZE, max_inflight=MAX_INFLIGHT):
+    copied = 0
+    zero_digests = {}
+    unsynced = 0
+    zero_chunk = bytes(chunk_size)
+    with open(source, 'rb', buffering=0) as src, open(target, 'r+b', buffering=0) as trgt:
+        writeback = Writeback(trgt.fileno(), max_inflight)
+        size = src.seek(0, 2)
+        ranges = used_ranges(src.fileno(), size) or [(0, size)]
+        for offset, length in ranges:
+            end = min(offset + length, size)
+            offset = max(offset, start)
+            while offset < end:
+                data = pread(src.fileno(), min(chunk_size - offset % chunk_size, end - offset), offset)
+                if data == zero_chunk[:len(data)]:
+                    zero_range(trgt.fileno(), offset, len(data))
+                    if digests is not None:
+                        if len(data) not in zero_digests:
+                            zero_digests[len(data)] = chunk_digest(data)
+                        digests.append((offset, len(data), zero_digests[len(data)]))
+                else:
+                    pwrite(trgt.fileno(), data, offset)
+                    writeback.written(offset, len(data))
+                    copied += len(data)
+                    if digests is not None:
+                        digests.append((offset, len(data), chunk_digest(data)))
+                posix_fadvise(src.fileno(), offset, len(data), POSIX_FADV_DONTNEED)
+                offset += len(data)
+                unsynced += len(data)
+                if checkpoint is not None and unsynced >= CHECKPOINT_SIZE:
+                    fsync(trgt.fileno())
+                    checkpoint(offset)
+                    unsynced = 0
+        writeback.finish()
+        fsync(trgt.fileno())
+    return copied
+
+def hash_partition(source, used_ranges, chunk_size=CHUNK_SIZE):
+    digests = []
+    with open(source, 'rb', buffering=0) as src:
+        size = src.seek(0, 2)
+        for offset, length in used_ranges(src.fileno(), size) or [(0, size)]:
+            end = min(offset + length, size)
+            while offset < end:
+                data = pread(src.fileno(), min(chunk_size - offset % chunk_size, end - offset), offset)
+                digests.append((offset, len(data), chunk_digest(data)))
+                offset += len(data)
+    return digests
+
+def open_uncached(target, flags):
+    fd = os_open(target, flags)
+    try:
+        return fd, os_open(target, flags | O_DIRECT)
+    except OSError:
+        return fd, None
+
+def close_uncached(fd, direct_fd):
+    os_close(fd)
+    if direct_fd is not None:
+        os_close(direct_fd)
+
+def read_uncached(fd, direct_fd, offset, length):
+    if direct_fd is None or offset % DIRECT_ALIGNMENT:
+        posix_fadvise(fd, offset, length, POSIX_FADV_DONTNEED)
+        return pread(fd, length, offset)
+    buffer = mmap.mmap(-1, -(-length // DIRECT_ALIGNMENT) * DIRECT_ALIGNMENT)
+    read = preadv(direct_fd, [buffer], offset)
+    return buffer[:min(read, length)]
+
+def verify_digests(target, digests, threads=4):
+    fd, direct_fd = open_uncached(target, O_RDONLY)
+    try:
+        def check(entry):
+            offset, length, digest = entry
+            if chunk_digest(read_uncached(fd, direct_fd, offset, length)) != digest:
+                return offset
+            return None
+        with ThreadPoolExecutor(max_workers=threads) as pool:
+            bad_offsets = [offset for offset in pool.map(check, digests) if offset is not None]
+    finally:
+        close_uncached(fd, direct_fd)
+    return min(bad_offsets) if bad_offsets else None
+
+def hash_device(target, size, threads=4):
+    return rehash_blocks(target, size, [None] * -(-size // DELTA_BLOCK), [(0, size)], threads)
+
+def rehash_blocks(target, size, hashes, ranges, threads=4):
+    hashes = list(hashes)
+    blocks = sorted({block for offset, length in ranges for block in range(offset // DELTA_BLOCK, min(-(-(offset + length) // DELTA_BLOCK), len(hashes)))})
+    fd, direct_fd = open_uncached(target, O_RDONLY)
+    try:
+        read_block = lambda block: chunk_digest(read_uncached(fd, direct_fd, block * DELTA_BLOCK, min(DELTA_BLOCK, size - block * DELTA_BLOCK)))
+        with ThreadPoolExecutor(max_workers=threads) as pool:
+            for block, digest in zip(blocks, pool.map(read_block, blocks)):
+                hashes[block] = digest
+    finally:
+        close_uncached(fd, direct_fd)
+    return hashes
+
+def drive_stamp(target):
+    fd, direct_fd = open_uncached(target, O_RDONLY)
+    try:
+        head = read_uncached(fd, direct_fd, 0, MiB)
+        digest = hashlib.sha256(head)
+        for entry in range(4):
+            start, size = struct.unpack_from('<II', head, 446 + 16 * entry + 8)
+            if head[446 + 16 * entry + 4] and size:
+                digest.update(read_uncached(fd, direct_fd, start * 512, 64 * 1024))
+    finally:
+        close_uncached(fd, direct_fd)
+    return digest.hexdigest()
+
+def write_changed(fd, data, position, index, block_digests):
+    written = 0
+    for pos in range(0, len(data), DELTA_BLOCK):
+        block = data[pos:pos + DELTA_BLOCK]
+        number = (position + pos) // DELTA_BLOCK
+        if index == 'read':
+            same = chunk_digest(pread(fd, len(block), position + pos)) == block_digests[pos // DELTA_BLOCK]
+        else:
+            same = number < len(index) and index[number] == block_digests[pos // DELTA_BLOCK]
+        if not(same):
+            pwrite_all(fd, block, position + pos)
+            written += len(block)
+    return written
+
+def probe_capacity(target, size, points=16):
+    token = urandom(16)
+    offsets = sorted(set([size * point // points // MiB * MiB for point in range(points)] + [size // MiB * MiB - MiB]))
+    markers = {}
+    fd, direct_fd = open_uncached(target, O_RDWR)
+    try:
+        for offset in offsets:
+            marker = mmap.mmap(-1, DIRECT_ALIGNMENT)
+            marker.write((token + offset.to_bytes(16, 'little')) * (DIRECT_ALIGNMENT // 32))
+            markers[offset] = bytes(marker)
+            pwrite(fd if direct_fd is None else direct_fd, marker, offset)
+        fsync(fd if direct_fd is None else direct_fd)
+        for offset in offsets:
+            if read_uncached(fd, direct_fd, offset, DIRECT_ALIGNMENT) != markers[offset]:
+                return offset
+    finally:
+        close_uncached(fd, direct_fd)
+    return None
+
+def verify_tree(source, target, threads=8, chunk_size=MiB):
+    sync()
+    files = []
+    device = lstat(source).st_dev
+    for directory, directories, names in walk(source):
+        directories[:] = [name for name in directories if lstat(f'{directory}/{name}').st_dev == device]
+        for name in names:
+            if S_ISREG(lstat(f'{directory}/{name}').st_mode):
+                files.append(path.relpath(f'{directory}/{name}', source))
+
+    def compare(relative):
+        with open(f'{source}/{relative}', 'rb', buffering=0) as src, open(f'{target}/{relative}', 'rb', buffering=0) as trgt:
+            posix_fadvise(trgt.fileno(), 0, 0, POSIX_FADV_DONTNEED)
+            offset = 0
+            while True:
+                expected = src.read(chunk_size)
+                found = trgt.read(chunk_size)
+                if expected != found:
+                    return relative, offset + next((pos for pos, pair in enumerate(zip(expected, found)) if pair[0] != pair[1]), min(len(expected), len(found)))
+                if not(expected):
+                    return None
+                offset += len(expected)
+
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        for difference in pool.map(compare, files):
+            if difference is not None:
+                return difference
+    return None
+
+def copy_file_data(source, target, size, budget=None):
+    src = os_open(source, O_RDONLY)
+    try:
+        trgt = os_open(target, O_WRONLY | O_CREAT | O_TRUNC, 0o600)
+        try:
+            copied = 0
+            method = copy_file_range
+            while copied < size:
+                try:
+                    if method is copy_file_range:
+                        count = copy_file_range(src, trgt, min(size - copied, 1 << 30))
+                    else:
+                        count = sendfile(trgt, src, None, min(size - copied, 1 << 30))
+                except OSError as e:
+                    if method is copy_file_range and e.errno in [EXDEV, ENOSYS, EINVAL, EOPNOTSUPP]:
+                        method = sendfile
+                        continue
+                    raise
+                if not(count):
+                    break
+                copied += count
+            if copied:
+                sync_file_range(trgt, 0, 0, SYNC_FILE_RANGE_WRITE)
+        finally:
+            os_close(trgt)
+        posix_fadvise(src, 0, 0, POSIX_FADV_DONTNEED)
+    finally:
+        os_close(src)
+    if budget is not None:
+        budget.add(copied)
+    return copied
+
+def copy_metadata(source, target, entry_stat):
+    is_link = S_ISLNK(entry_stat.st_mode)
+    lchown(target, entry_stat.st_uid, entry_stat.st_gid)
+    if not(is_link):
+        chmod(target, S_IMODE(entry_stat.st_mode))
+    try:
+        for name in listxattr(source, follow_symlinks=False):
+            setxattr(target, name, getxattr(source, name, follow_symlinks=False), follow_symlinks=False)
+    except OSError as e:
+        if e.errno != EOPNOTSUPP:
+            raise
+    utime(target, ns=(entry_stat.st_atime_ns, entry_stat.st_mtime_ns), follow_symlinks=False)
+
+def copy_entry(source, target, entry_stat, budget=None):
+    if S_ISREG(entry_stat.st_mode):
+        return copy_file_data(source, target, entry_stat.st_size, budget)
+    if path.lexists(target):
+        unlink(target)
+    if S_ISLNK(entry_stat.st_mode):
+        symlink(readlink(source), target)
+    else:
+        mknod(target, entry_stat.st_mode, entry_stat.st_rdev)
+    return 0
+
+def scan_directory(directory):
+    with scandir(directory) as entries:
+        return [(entry.name, entry.stat(follow_symlinks=False)) for entry in entries]
+
+def copy_tree(source, target, threads=COPY_THREADS, pending_limit=4096, max_inflight=MAX_INFLIGHT):
+    device = lstat(source).st_dev
+    target_fd = os_open(target, O_RDONLY | O_DIRECTORY)
+    budget = WriteBudget(max_inflight, partial(syncfs, target_fd))
+    try:
+        metadata = []
+        directories = []
+        hardlinks = {}
+        links = []
+        copied = 0
+        with ThreadPoolExecutor(max_workers=threads) as pool:
+            scans = {pool.submit(scan_directory, source): (source, target)}
+            copies = set()
+            while scans:
+                done, not_done = wait(scans, return_when=FIRST_COMPLETED)
+                for future in done:
+                    source_directory, target_directory = scans.pop(future)
+                    for name, entry_stat in future.result():
+                        entry = (f'{source_directory}/{name}', f'{target_directory}/{name}', entry_stat)
+                        if S_ISDIR(entry_stat.st_mode):
+                            try:
+                                mkdir(entry[1], 0o700)
+                            except FileExistsError:
+                                pass
+                            directories.append(entry)
+                            if entry_stat.st_dev == device:
+                                scans[pool.submit(scan_directory, entry[0])] = entry[:2]
+                            continue
+                        if entry_stat.st_nlink > 1:
+                            key = (entry_stat.st_dev, entry_stat.st_ino)
+                            if key in hardlinks:
+                                links.append((hardlinks[key], entry[1]))
+                                continue
+                            hardlinks[key] = entry[1]
+                        metadata.append(entry)
+                        if len(copies) >= pending_limit:
+                            finished, copies = wait(copies, return_when=FIRST_COMPLETED)
+                            copied += sum(copy.result() for copy in finished)
+                        copies.add(pool.submit(copy_entry, *entry, budget))
+            copied += sum(copy.result() for copy in copies)
+            for first, target_path in links:
+                if path.lexists(target_path):
+                    unlink(target_path)
+                link(first, target_path, follow_symlinks=False)
+            for future in [pool.submit(copy_metadata, *entry) for entry in metadata]:
+                future.result()
+        for entry in sorted(directories, key=lambda entry: entry[1].count('/'), reverse=True):
+            copy_metadata(*entry)
+        copy_metadata(source, target, lstat(source))
+        syncfs(target_fd)
+    finally:
+        os_close(target_fd)
+    return copied
+
+def used_bytes(directory):
+    usage = statvfs(directory)
+    return (usage.f_blocks - usage.f_bfree) * usage.f_frsize
+
+def read_lines(filelocation):
+    with open(filelocation, 'r') as file:
+        return file.readlines()
+
+def write_lines(filelocation, content):
+    with open(filelocation, 'w') as file:
+        for line in content:
+            file.write(line + '\n')
+
+def is_compressed(image):
+    return any(image.endswith(extension) for extension in COMPRESSED_TYPES)
+
+def is_stored(image):
+    return image.startswith(STORE_PREFIX)
+
+def stat_image(image):
+    return stat(image[len(STORE_PREFIX):] if is_stored(image) else image)
+
+def load_manifest(image):
+    with open(image[len(STORE_PREFIX):], 'r') as file:
+        manifest = json.load(file)
+    if manifest.get('version') != STORE_VERSION:
+        raise Exception(f'{image} was stored by an incompatible version.')
+    return manifest
+
+def store_chunks(stream):
+    pending = bytearray()
+    position = STORE_MIN_CHUNK - STORE_BLOCK
+    while True:
+        data = read_chunk(stream, CHUNK_SIZE)
+        pending += data
+        while True:
+            cut = None
+            for offset in range(position, len(pending) - STORE_BLOCK + 1, STORE_BLOCK):
+                if offset + STORE_BLOCK >= STORE_MAX_CHUNK or zlib.crc32(pending[offset:offset + STORE_BLOCK]) & STORE_MASK == 0:
+                    cut = offset + STORE_BLOCK
+                    break
+                position = offset + STORE_BLOCK
+            if cut is None:
+                break
+            yield bytes(pending[:cut])
+            del pending[:cut]
+            position = STORE_MIN_CHUNK - STORE_BLOCK
+        if not(data):
+            if pending:
+                yield bytes(pending)
+            return
+
+def store_image(image, store, name):
+    makedirs(f'{store}/images', exist_ok=True)
+    digest = hashlib.sha256()
+    chunks = []
+    new = 0
+    stream, process = open_image_stream(image)
+    with stream:
+        for data in store_chunks(stream):
+            digest.update(data)
+            if data.count(0) == len(data):
+                chunks.append([None, len(data)])
+                continue
+            key = hashlib.sha256(data).hexdigest()
+            chunk_file = f'{store}/chunks/{key[:2]}/{key}'
+            if not(path.exists(chunk_file)):
+                makedirs(path.dirname(chunk_file), exist_ok=True)
+                with open(chunk_file + '.tmp', 'wb') as file:
+                    file.write(data)
+                rename(chunk_file + '.tmp', chunk_file)
+                new += len(data)
+            chunks.append([key, len(data)])
+    if process is not None and process.wait() != 0:
+        raise Exception(*process.stderr.read().decode().strip('\n').split('\n'))
+    manifest = {'version': STORE_VERSION, 'size': sum(length for key, length in chunks), 'sha256': digest.hexdigest(), 'chunks': chunks}
+    sync()
+    manifest_file = f'{store}/images/{name}.json'
+    with open(manifest_file + '.tmp', 'w') as file:
+        json.dump(manifest, file)
+    rename(manifest_file + '.tmp', manifest_file)
+    return manifest, new
+
+def zip_image_member(image):
+    with zipfile.ZipFile(image) as archive:
+        members = [name for name in archive.namelist() if name.endswith('.img')] or archive.namelist()
+    return members[0]
+
+def decompress_command(image):
+    if image.endswith('.xz') and which('xz'):
+        return f'xz -dc -T0 {shlex.quote(image)}'
+    if image.endswith('.gz') and (which('pigz') or which('gzip')):
+        return f"{'pigz' if which('pigz') else 'gzip'} -dc {shlex.quote(image)}"
+    if image.endswith('.zst') and which('zstd'):
+        return f'zstd -dc -T0 {shlex.quote(image)}'
+    if image.endswith('.zip') and which('unzip'):
+        return f'unzip -p {shlex.quote(image)} {shlex.quote(zip_image_member(image))}'
+    return None
+
+def open_image_stream(image):
+    if is_stored(image):
+        return StoreReader(image), None
+    command = decompress_command(image)
+    if command is not None:
+        process = subprocess.Popen(command, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        return process.stdout, process
+    if image.endswith('.xz'):
+        return lzma.open(image, 'rb'), None
+    if image.endswith('.gz'):
+        return gzip.open(image, 'rb'), None
+    if image.endswith('.zip'):
+        return zipfile.ZipFile(image).open(zip_image_member(image)), None
+    if image.endswith('.zst'):
+        raise Exception('zstd is needed to decompress .zst images.')
+    return open(image, 'rb', buffering=0), None
+
+def read_chunk(stream, size):
+    chunks = []
+    remaining = size
+    while remaining:
+        data = stream.read(remaining)
+        if not(data):
+            break
+        chunks.append(data)
+        remaining -= len(data)
+    return b''.join(chunks)
+
+def write_all(fd, data):
+    view = memoryview(data)
+    while view:
+        view = view[write(fd, view):]
+
+def pwrite_all(fd, data, offset):
+    view = memoryview(data)
+    while view:
+        written = pwrite(fd, view, offset)
+        view = view[written:]
+        offset += written
+
+def stream_to_targets(stream, targets, offsets=None, checkpoint=None, digests=None, indexes=None, blocks=None, chunk_size=CHUNK_SIZE, depth=4, max_inflight=MAX_INFLIGHT):
+    queues = {target: Queue(maxsize=depth) for target in targets}
+    errors = {target: None for target in targets}
+    written = {target: 0 for target in targets}
+    offsets = offsets or {}
+    indexes = indexes or {}
+
+    def writer(target):
+        queue = queues[target]
+        item = (b'', None)
+        position = 0
+        unsynced = 0
+        try:
+            fd = os_open(target, O_RDWR if indexes.get(target) == 'read' else O_WRONLY)
+            writeback = Writeback(fd, max_inflight)
+            try:
+                while True:
+                    item = queue.get()
+                    if item is None:
+                        break
+                    data, block_digests = item
+                    if position + len(data) > offsets.get(target, 0):
+                        skip = max(0, offsets.get(target, 0) - position)
+                        if indexes.get(target) is None:
+                            pwrite_all(fd, memoryview(data)[skip:], position + skip)
+                            written[target] += len(data) - skip
+                        else:
+                            written[target] += write_changed(fd, memoryview(data), position, indexes[target], block_digests)
+                        writeback.written(position + skip, len(data) - skip)
+                        unsynced += len(data) - skip
+                    position += len(data)
+                    if checkpoint is not None and unsynced >= CHECKPOINT_SIZE:
+                        fsync(fd)
+                        checkpoint(target, position)
+                        unsynced = 0
+                writeback.finish()
+                fsync(fd)
+            finally:
+                os_close(fd)
+        except Exception as e:
+            errors[target] = str(e)
+            while item is not None:
+                item = queue.get()
+
+    threads = [Thread(target=writer, args=(target,)) for target in targets]
+    for thread in threads:
+        thread.start()
+    streamed = 0
+    while True:
+        data = read_chunk(stream, chunk_size)
+        if not(data) or all(error is not None for error in errors.values()):
+            break
+        block_digests = None
+        if blocks is not None or any(index is not None for index in indexes.values()):
+            block_digests = [chunk_digest(data[pos:pos + DELTA_BLOCK]) for pos in range(0, len(data), DELTA_BLOCK)]
+            if blocks is not None:
+                blocks += block_digests
+        for queue in queues.values():
+            queue.put((data, block_digests))
+        if digests is not None:
+            digests.append((streamed, len(data), chunk_digest(data)))
+        streamed += len(data)
+    for queue in queues.values():
+        queue.put(None)
+    for thread in threads:
+        thread.join()
+    return errors, streamed, written
+
+def parse_size(size):
+    size = str(size).strip().upper().rstrip('B').rstrip('I')
+    if size and size[-1] in SIZE_UNITS:
+        return int(float(size[:-1]) * SIZE_UNITS[size[-1]])
+    return int(size)
+
+def stream_to_file(stream, target, chunk_size=CHUNK_SIZE, max_inflight=MAX_INFLIGHT):
+    zero_chunk = bytes(chunk_size)
+    with open(target, 'wb', buffering=0) as file:
+        writeback = Writeback(file.fileno(), max_inflight)
+        while True:
+            data = read_chunk(stream, chunk_size)
+            if not(data):
+                break
+            if data == zero_chunk[:len(data)]:
+                file.seek(len(data), 1)
+            else:
+                position = file.tell()
+                write_all(file.fileno(), data)
+                writeback.written(position, len(data))
+        file.truncate()
+        writeback.finish()
+        fsync(file.fileno())
+
+def lock_directory(directory):
+    fd = os_open(directory, O_RDONLY | O_DIRECTORY)
+    flock(fd, LOCK_EX)
+    return fd
+
+def evict_cache(cache, limit, keep):
+    images = []
+    for name in listdir(cache):
+        if name.endswith('.img') or name.endswith('.img.tmp'):
+            try:
+                image_stat = stat(f'{cache}/{name}')
+            except FileNotFoundError:
+                continue
+            images.append((image_stat.st_mtime, image_stat.st_blocks * 512, f'{cache}/{name}'))
+    used = sum(size for mtime, size, image in images)
+    for mtime, size, image in sorted(images):
+        if used <= limit:
+            break
+        if image != keep:
+            try:
+                remove(image)
+            except FileNotFoundError:
+                pass
+            used -= size
 
 def disclaimer():
     disclaimer = [